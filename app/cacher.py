@@ -7,6 +7,9 @@ Uses Mercurial to track older revisions - more efficient than git for this use c
 import json
 import pathlib
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from no_cache import discard_serializer
@@ -14,8 +17,13 @@ from requests_cache import CachedSession
 
 TIME_LIMIT = 600
 
+# subdirectories fetched at once; each is committed by one thread. requests_cache
+# reads each whole response into memory, even with stream=True, so this also
+# bounds memory use.
+POOL_SIZE = 3
 
-def update_cache():
+
+def make_session():
     session = CachedSession(
         "http_cache_repodata",
         allowable_codes=[200, 206],
@@ -29,6 +37,17 @@ def update_cache():
         conn.execute("PRAGMA journal_mode=wal")
 
     session.headers["User-Agent"] = "repodata.fly.dev/0.0.1"
+    return session
+
+
+def update_cache():
+    # sessions, and their sqlite connections, are not shared between threads
+    local = threading.local()
+
+    def thread_session():
+        if not hasattr(local, "session"):
+            local.session = make_session()
+        return local.session
 
     REPOS = [
         "repo.anaconda.com/pkgs/main",
@@ -97,41 +116,57 @@ def update_cache():
         )
     )
 
-    for repo in REPOS:
-        for subdir in SUBDIRS:
-            for url in [
-                f"https://{repo}/{subdir}/repodata.json",
-                f"https://{repo}/{subdir}/current_repodata.json",
-            ]:
-                response = session.get(url)
-                print(response.from_cache, url)
-                print(response.cache_key)
-
-                print(
-                    {
-                        k: v
-                        for k, v in response.headers.lower_items()
-                        if k in SHOW_HEADERS
-                    }
-                )
-                output = pathlib.Path(url.lstrip("https://"))
-                headers = output.with_stem(f"{output.stem}-headers")
-                if not output.exists() or not response.from_cache:
-                    try:
-                        json.loads(response.content)
-                    except json.decoder.JSONDecodeError:
-                        print("NOT JSON")
-                        continue
-
-                    output.parent.mkdir(parents=True, exist_ok=True)
-
-                    if output.is_symlink():
-                        output.unlink()  # if symlink was broken?
-
-                    output.write_bytes(response.content)
-                    headers.write_text(json.dumps(dict(response.headers.lower_items())))
-
-                commit(output.parent)
+    def update_subdir(repo, subdir):
+        for url in [
+            f"https://{repo}/{subdir}/repodata.json",
+            f"https://{repo}/{subdir}/current_repodata.json",
+        ]:
+            begin = time.monotonic()
+            response = thread_session().get(url)
+            print(response.from_cache, url)
+            print(response.cache_key)
+
+            print(
+                {k: v for k, v in response.headers.lower_items() if k in SHOW_HEADERS}
+            )
+            output = pathlib.Path(url.lstrip("https://"))
+            headers = output.with_stem(f"{output.stem}-headers")
+            if not output.exists() or not response.from_cache:
+                try:
+                    json.loads(response.content)
+                except json.decoder.JSONDecodeError:
+                    print("NOT JSON", url)
+                    continue
+
+                output.parent.mkdir(parents=True, exist_ok=True)
+
+                if output.is_symlink():
+                    output.unlink()  # if symlink was broken?
+
+                output.write_bytes(response.content)
+                headers.write_text(json.dumps(dict(response.headers.lower_items())))
+
+            # let go of the body before the commit, not at the next request
+            del response
+
+            print(f"{url} in {time.monotonic() - begin:0.02f}s")
+
+            # one thread per subdir, so commits to its repository don't overlap
+            commit(output.parent)
+
+    begin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+        futures = [
+            executor.submit(update_subdir, repo, subdir)
+            for repo in REPOS
+            for subdir in SUBDIRS
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("FAILED", e)
+    print(f"Updated {len(futures)} subdirs in {time.monotonic() - begin:0.02f}s")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+"""
+Apply json patches to repodata.json faster than jsonpatch.
+
+Repodata patches are thousands of add, remove and replace operations on
+/packages/<filename> and /packages.conda/<filename>. Here each path is parsed
+once, and the container under a top-level key is looked up once for each run
+of operations under that key, instead of resolving a JsonPointer per
+operation. Other operations, and any operation that would fail, are handed to
+jsonpatch one at a time, so results and errors are the same as
+jsonpatch.apply_patch(doc, patch, in_place=True).
+"""
+
+import jsonpatch
+
+FAST_OPS = ("add", "remove", "replace")
+
+
+def parse_path(path):
+    """
+    Return list of tokens in JSON pointer path, or None if it is not a pointer
+    below the document root.
+    """
+    if not isinstance(path, str) or not path.startswith("/"):
+        return None
+    return [
+        token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")
+    ]
+
+
+class CompiledPatch:
+    """
+    Json patch with paths parsed ahead of time; may be applied more than once.
+    """
+
+    def __init__(self, patch):
+        self.steps = []
+        for op in patch:
+            tokens = None
+            if op.get("op") in FAST_OPS and (op["op"] == "remove" or "value" in op):
+                tokens = parse_path(op.get("path"))
+            self.steps.append((op, tokens))
+
+    def apply(self, doc):
+        """
+        Apply patch to doc in place. Return doc, which is a new object only if
+        the patch replaced the whole document.
+        """
+        top_key = top = None
+        for op, tokens in self.steps:
+            if tokens is not None and isinstance(doc, dict):
+                if len(tokens) == 1:
+                    # may replace the cached top-level container
+                    parent = doc
+                    top_key = top = None
+                else:
+                    if top_key != tokens[0] or top is None:
+                        top_key = tokens[0]
+                        top = doc.get(top_key)
+                    parent = top
+                    for token in tokens[1:-1]:
+                        if not isinstance(parent, dict):
+                            break
+                        parent = parent.get(token)
+
+                key = tokens[-1]
+                if isinstance(parent, dict):
+                    name = op["op"]
+                    if name == "add":
+                        parent[key] = op["value"]
+                        continue
+                    elif key in parent:
+                        if name == "replace":
+                            parent[key] = op["value"]
+                        else:
+                            del parent[key]
+                        continue
+
+            # lists, test, move, copy, errors...
+            doc = jsonpatch.apply_patch(doc, [op], in_place=True)
+            top_key = top = None
+
+        return doc
+
+
+def apply_patch(doc, patch):
+    """
+    Apply list of json patch operations to doc in place; return patched doc.
+    """
+    return CompiledPatch(patch).apply(doc)
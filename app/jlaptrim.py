@@ -5,45 +5,84 @@ Rewrite .jlap if too big.
 from __future__ import annotations
 
 import logging
+import shutil
 from pathlib import Path
 
 import click
-from jlapcore import jlap_buffer, write_jlap_buffer
+from truncateable import JlapLines
 
 log = logging.getLogger("__name__")
 
+COPY_BLOCK_SIZE = 2**16
 
-def trim(jlap: Path, target_size: int, target_path: Path | None = None):
-    if not target_path:
-        target_path = jlap
 
-    def lines():
-        for line in jlap.open("rb"):
-            # strip trailing \n if present
-            if line.endswith(b"\n"):
-                yield line[:-1]
-            else:
-                yield line  # ugly
+def cut_offset(reader: JlapLines, target_size: int | None, count: int | None):
+    """
+    Return offset of the first line to keep, so that the patches after it fit
+    in target_size bytes and number at most count; or None if nothing needs
+    to be removed.
+    """
+    cut = reader.start
+    if target_size is not None:
+        limit = reader.trailer_offset - target_size
+        if limit > 0:
+            # the first line at or after limit is replaced by the new iv
+            first = reader.data.find(b"\n", max(limit, reader.start) - 1) + 1
+            cut = max(cut, reader.data.find(b"\n", first) + 1)
+    if count is not None:
+        # metadata line and count patches
+        line = None
+        for _, line in zip(range(count + 1), reader.reversed()):
+            pass
+        if line is not None:
+            cut = max(cut, line.offset)
+    if cut <= reader.start:
+        return None
+    return cut
+
+
+def trim(
+    jlap: Path,
+    target_size: int | None,
+    target_path: Path | None = None,
+    count: int | None = None,
+):
+    """
+    Remove the oldest patches from jlap so that it is smaller than target_size
+    bytes and has at most count patches. Write to target_path, default jlap.
+
+    Only the removed lines are hashed, to find the new iv; the rest of the
+    file is copied without being read into memory.
 
-    buffer = jlap_buffer(lines(), iv=b"", pos=0)
+    Return True if trimmed.
+    """
+    if count is not None and count < 0:
+        raise ValueError(f"count must be >= 0, not {count}")
 
-    end_position = buffer[-1][0]
+    if not target_path:
+        target_path = jlap
 
-    if end_position <= target_size:
-        return False  # write to target_path?
+    with jlap.open("rb") as fp:
+        with JlapLines(fp) as reader:
+            cut = cut_offset(reader, target_size, count)
 
-    limit_position = end_position - target_size
+            # don't write degenerate .jlap
+            if cut is None or cut > next(reader.reversed()).offset:
+                return False
 
-    buffer = [element for element in buffer if element[0] >= limit_position]
-    # replace first line with iv for second line.
-    # breaks if buffer is empty...
-    buffer[0] = (0, buffer[0][2], buffer[0][2])
+            iv = reader.iv
+            for line in reader:
+                if line.offset >= cut:
+                    break
+                iv = line.lineid
 
-    # don't write degenerate .jlap
-    if len(buffer) < 2:
-        return False
+        target_temp = target_path.with_name(target_path.name + ".tmp")
+        with target_temp.open("wb") as out:
+            out.write(iv.hex().encode("utf-8") + b"\n")
+            fp.seek(cut)
+            shutil.copyfileobj(fp, out, COPY_BLOCK_SIZE)
 
-    write_jlap_buffer(target_path, buffer)
+    target_temp.replace(target_path)
 
     return True
 
@@ -77,10 +116,18 @@ def trim_if_larger(high: int, low: int, jlap: Path):
     default=2**20 * 3,
     show_default=True,
 )
+@click.option(
+    "--count",
+    required=False,
+    type=click.IntRange(min=0),
+    help="Keep at most this many patches.",
+)
 @click.argument("jlap")
-def jlaptrim(high: int, low: int, jlap):
+def jlaptrim(high: int, low: int, count: int | None, jlap):
     jlap = Path(jlap).expanduser()
     trim_if_larger(high, low, jlap)
+    if count is not None:
+        trim(jlap, None, count=count)
 
 
 def go():
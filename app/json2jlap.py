@@ -7,10 +7,14 @@ Read */repodata.jlap
 
 Diff */repodata.json with */.cache/repodata.json
 
-Write */repodata.jlap
+Append to */repodata.jlap
 
 Same for current_repodata.jlap
 
+Every squash.CHECKPOINT_INTERVAL patches, keep a copy of repodata.json in
+*/.cache, and write squashed patches from those checkpoints to the latest
+repodata.json.
+
 If output jlap is larger than a set size, remove older diffs.
 """
 
@@ -20,13 +24,17 @@ import itertools
 import json
 import logging
 import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from hashlib import blake2b
 from io import IOBase
 from pathlib import Path
 
 import click
-import jsonpatch
-from truncateable import JlapReader, JlapWriter
+import repodata_diff
+import squash
+from truncateable import JlapLines, append_lines, lazy_patch
 from jlaptrim import trim_if_larger
 
 log = logging.getLogger("__name__")
@@ -65,16 +73,70 @@ def hash_and_load(path):
     return obj, h.hash.digest()
 
 
+def checkpoint_paths(cache: Path, repodata: Path):
+    """
+    Return {digest: path} of saved checkpoints of repodata, newest first.
+    """
+    paths = sorted(
+        cache.glob(f"{repodata.stem}.*.checkpoint.json"),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    return {path.name.split(".")[-3]: path for path in paths}
+
+
+def read_patches(jlapfile: Path):
+    """
+    Return patches in jlapfile, oldest first, without parsing their
+    operations or checking the summary hash.
+    """
+    with jlapfile.open("rb") as fp, JlapLines(fp) as jlap:
+        lines = list(jlap.reversed())[1:]  # without metadata
+    lines.reverse()
+    return [lazy_patch(line.raw) for line in lines]
+
+
+def squash_checkpoints(cache: Path, repodata: Path, patches, current, current_digest):
+    """
+    Return squashed patches from saved checkpoints to current; remove
+    checkpoints that are no longer in patches.
+    """
+    squashed = []
+    kept = 0
+    for digest, path in checkpoint_paths(cache, repodata).items():
+        steps = squash.steps_since(patches, digest)
+        if steps is None or kept >= squash.MAX_CHECKPOINTS:
+            log.info("Remove checkpoint %s", path)
+            path.unlink()
+            continue
+        kept += 1
+        if squash.genuine(patches)[-1]["from"] == digest:
+            continue  # same as the last patch
+        checkpoint, _ = hash_and_load(path)
+        patch = squash.squash(checkpoint, digest, current, current_digest, steps)
+        if patch and len(patch["patch"]) <= PATCH_STEPS_LIMIT:
+            squashed.append(squash.dumps(patch))
+    return squashed
+
+
+def save_checkpoint(cache: Path, repodata: Path, previous: Path, digest, patches):
+    """
+    Copy previous repodata.json with digest to a checkpoint if there have been
+    squash.CHECKPOINT_INTERVAL patches since the newest checkpoint.
+    """
+    newest = next(iter(checkpoint_paths(cache, repodata)), None)
+    since = [patch["from"] for patch in squash.genuine(patches)]
+    interval = squash.CHECKPOINT_INTERVAL
+    if newest in since and len(since) - since.index(newest) < interval:
+        return
+    log.info("Checkpoint %s at %s", repodata, digest)
+    shutil.copyfile(previous, cache / f"{repodata.stem}.{digest}.checkpoint.json")
+
+
 def json2jlap_one(cache: Path, repodata: Path):
     previous_repodata = cache / (repodata.name + ".last")
 
-    patches = []
-
     jlapfile = (repodata.parent / repodata.name).with_suffix(".jlap")
-    if jlapfile.exists():
-        with jlapfile.open("rb") as jlap:
-            patchfile = JlapReader(jlap)
-            *patches, metadata = list(patch for patch, _ in patchfile.readobjs())
 
     if (
         previous_repodata.exists()
@@ -83,31 +145,44 @@ def json2jlap_one(cache: Path, repodata: Path):
         current, current_digest = hash_and_load(repodata)
         previous, previous_digest = hash_and_load(previous_repodata)
 
-        jpatch = jsonpatch.make_patch(previous, current)
+        jpatch = repodata_diff.make_patch(previous, current)
+
+        new_patches = []
 
         # inconvenient to add bytes size limit here; limit number of steps?
         if previous_digest == current_digest:
             log.warn("Skip identical %s", repodata)
-        elif len(jpatch.patch) > PATCH_STEPS_LIMIT:
-            log.warn("Skip large %s-step patch", len(jpatch.patch))
+        elif len(jpatch) > PATCH_STEPS_LIMIT:
+            log.warn("Skip large %s-step patch", len(jpatch))
         else:
-            patches.append(
-                {
-                    "to": current_digest.hex(),
-                    "from": previous_digest.hex(),
-                    "patch": jpatch.patch,
-                }
+            patch = {
+                "to": current_digest.hex(),
+                "from": previous_digest.hex(),
+                "patch": jpatch,
+            }
+            # serialized once
+            new_patches.append(dict(patch, raw=squash.dumps(patch)))
+
+        patches = read_patches(jlapfile) if jlapfile.exists() else []
+        patches = squash.genuine(patches) + new_patches
+
+        squashed = squash_checkpoints(
+            cache, repodata, patches, current, current_digest.hex()
+        )
+
+        # rewrites only the old squashed patches and the lines after them
+        append_lines(
+            jlapfile,
+            (line["raw"] for line in new_patches),
+            {"url": repodata.name, "latest": current_digest.hex()},
+            squashed,
+        )
+
+        if patches and patches[-1]["from"] == previous_digest.hex():
+            save_checkpoint(
+                cache, repodata, previous_repodata, previous_digest.hex(), patches
             )
 
-        # metadata
-        patches.append({"url": repodata.name, "latest": current_digest.hex()})
-
-        with jlapfile.open("wb+") as jlap:
-            patchfile = JlapWriter(jlap)
-            for patch in patches:
-                patchfile.write(patch)
-            patchfile.finish()
-
     if (
         not previous_repodata.exists()
         or repodata.stat().st_mtime > previous_repodata.stat().st_mtime
@@ -115,6 +190,29 @@ def json2jlap_one(cache: Path, repodata: Path):
         shutil.copyfile(repodata, previous_repodata)
 
 
+def json2jlap_subdir(cachedir: Path, repodatas: list[Path], trim_low, trim_high):
+    """
+    Update .jlap for each of repodatas, all in one subdir.
+
+    Return (seconds, formatted traceback or None); run in a worker process.
+    """
+    begin = time.monotonic()
+    try:
+        for repodata in repodatas:
+            json2jlap_one(cachedir, repodata)
+            if trim_high > trim_low:
+                repodata_jlap = repodata.with_suffix(".jlap")
+                if not repodata_jlap.exists():
+                    continue
+                trim_if_larger(trim_high, trim_low, repodata_jlap)
+        result = None
+    except Exception:
+        log.exception("%s failed", cachedir.parent.name)
+        # a str, which always pickles back to the parent process
+        result = traceback.format_exc()
+    return time.monotonic() - begin, result
+
+
 @click.command()
 @click.option("--cache", required=True, help="Cache directory.")
 @click.option("--repodata", required=True, help="Repodata directory.")
@@ -132,23 +230,60 @@ def json2jlap_one(cache: Path, repodata: Path):
     show_default=True,
     help="Trim if larger than size; 0 to disable.",
 )
-def json2jlap(cache, repodata, trim_low, trim_high):
+@click.option(
+    "--jobs",
+    required=False,
+    default=1,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="Number of subdirs to process in parallel.",
+)
+def json2jlap(cache, repodata, trim_low, trim_high, jobs):
     cache = Path(cache).expanduser()
     repodata = Path(repodata).expanduser()
     repodatas = itertools.chain(
         repodata.glob("*/repodata.json"), repodata.glob("*/current_repodata.json")
     )
+    subdirs: dict[Path, list[Path]] = {}
     for repodata in repodatas:
         # require conda-index's .cache folder
         cachedir = Path(cache, repodata.parent.name, ".cache")
         if not cachedir.is_dir():
             continue
-        json2jlap_one(cachedir, repodata)
-        if trim_high > trim_low:
-            repodata_jlap = repodata.with_suffix(".jlap")
-            if not repodata_jlap.exists():
-                continue
-            trim_if_larger(trim_high, trim_low, repodata_jlap)
+        subdirs.setdefault(cachedir, []).append(repodata)
+
+    results = {}
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    json2jlap_subdir, cachedir, paths, trim_low, trim_high
+                ): cachedir
+                for cachedir, paths in subdirs.items()
+            }
+            for future in as_completed(futures):
+                cachedir = futures[future]
+                try:
+                    results[cachedir] = future.result()
+                except Exception:
+                    # e.g. BrokenProcessPool if a worker died
+                    results[cachedir] = 0.0, traceback.format_exc()
+    else:
+        for cachedir, paths in subdirs.items():
+            results[cachedir] = json2jlap_subdir(cachedir, paths, trim_low, trim_high)
+
+    failed = 0
+    for cachedir, (seconds, result) in results.items():
+        if result is None:
+            log.info("%s in %0.2fs", cachedir.parent.name, seconds)
+        else:
+            log.error(
+                "%s failed after %0.2fs: %s", cachedir.parent.name, seconds, result
+            )
+            failed += 1
+
+    if failed:
+        raise SystemExit(f"{failed} of {len(subdirs)} subdirs failed")
 
 
 def go():
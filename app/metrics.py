@@ -0,0 +1,127 @@
+"""
+Minimal Prometheus-style metrics, rendered in the text exposition format.
+
+    REQUESTS = Counter("requests_total", "Requests.", ("channel",))
+    REQUESTS.inc(channel="conda-forge")
+
+    print(render())
+"""
+
+import abc
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self):
+        """
+        Yield (suffix, label values, extra labels, value) for each sample.
+        """
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(self.labelnames, labels, extra)} "
+                f"{format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield "", labels, (), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - begin, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self.values.items()
+            )
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", labels, (("le", format_value(bound)),), cumulative
+            yield "_sum", labels, (), total
+            yield "_count", labels, (), cumulative
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,246 @@
+"""
+Disk cache for package files (.conda, .tar.bz2) fetched through the proxy.
+
+Files are downloaded once, in a background thread, while any number of
+clients stream the partial file. The sha256 from repodata.json is checked
+before a download is kept, and before clients are sent the last HOLD_BYTES of
+the file. Least-recently-used files are removed to stay under a size limit.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+# kept from clients until the download's sha256 is checked
+HOLD_BYTES = CHUNK_SIZE
+
+# headers arriving from upstream, passed on to clients
+PASS_HEADERS = ("Content-Length", "Content-Type", "Last-Modified")
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+class Download:
+    """
+    Package file being written to temp_path by PackageCache.
+    """
+
+    def __init__(self, temp_path: Path, path: Path):
+        self.temp_path = temp_path
+        self.path = path
+        self.condition = threading.Condition()
+        self.headers = None
+        self.written = 0
+        self.done = False
+        self.error = None
+
+    def wait_headers(self):
+        """
+        Wait for the upstream response; return headers to send to the client.
+
+        Raise the download's exception if it failed before that.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.headers is not None or self.done)
+            if self.headers is None:
+                raise self.error
+            return self.headers
+
+    def follow(self):
+        """
+        Yield the file as it is downloaded, except for the last HOLD_BYTES,
+        which are only sent once the download is complete and checked.
+        """
+        position = 0
+        try:
+            fp = self.temp_path.open("rb")
+        except FileNotFoundError:
+            # finished and renamed, or failed
+            self.wait_headers()
+            if self.error:
+                raise self.error
+            fp = self.path.open("rb")
+        with fp:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.written - HOLD_BYTES > position or self.done
+                    )
+                    written, done, error = self.written, self.done, self.error
+                if error:
+                    # the client will see a short response
+                    raise error
+                available = written if done else written - HOLD_BYTES
+                if available > position:
+                    data = fp.read(min(available - position, CHUNK_SIZE))
+                    position += len(data)
+                    yield data
+                elif done:
+                    break
+
+
+class PackageCache:
+    """
+    Least-recently-used cache of package files under directory, limited to
+    max_bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.files = collections.OrderedDict()  # relative path: size
+        self.size = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # oldest access first
+        found = []
+        for path in self.directory.rglob("*"):
+            if path.is_file() and path.name.endswith((".conda", ".tar.bz2")):
+                stat = path.stat()
+                relpath = str(path.relative_to(self.directory))
+                found.append((stat.st_atime, relpath, stat.st_size))
+        for _, relpath, size in sorted(found):
+            self.files[relpath] = size
+            self.size += size
+        log.info(
+            "%d packages, %d bytes in %s", len(self.files), self.size, self.directory
+        )
+
+    def lookup(self, relpath):
+        """
+        Return path to cached package file, or None.
+        """
+        with self.lock:
+            if relpath not in self.files:
+                return None
+            self.files.move_to_end(relpath)
+        return self._touch(relpath)
+
+    def _touch(self, relpath):
+        """
+        Record use of cached relpath; return its path, or None if it is gone.
+        """
+        path = self.directory / relpath
+        try:
+            # track use in atime; mtime is sent as Last-Modified
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.files.pop(relpath, 0)
+            return None
+        return path
+
+    def fetch(self, relpath, url, sha256):
+        """
+        Return (path, None) if relpath is cached, else (None, Download of url
+        into relpath), joining one that is in progress.
+        """
+        with self.lock:
+            cached = relpath in self.files
+            if cached:
+                self.files.move_to_end(relpath)
+            elif relpath in self.downloads:
+                return None, self.downloads[relpath]
+            else:
+                temp = tempfile.NamedTemporaryFile(
+                    dir=self.directory, prefix=".download-", delete=False
+                )
+                temp.close()
+                download = self.downloads[relpath] = Download(
+                    Path(temp.name), self.directory / relpath
+                )
+
+        if cached:
+            path = self._touch(relpath)
+            if path is None:
+                # removed since the check; download it again
+                return self.fetch(relpath, url, sha256)
+            return path, None
+
+        threading.Thread(
+            target=self._download,
+            args=(relpath, url, sha256, download),
+            name=f"download {relpath}",
+            daemon=True,
+        ).start()
+
+        return None, download
+
+    def _download(self, relpath, url, sha256, download: Download):
+        hash = hashlib.sha256()
+        try:
+            with self.session.get(url, stream=True) as response:
+                response.raise_for_status()
+                headers = {
+                    key: response.headers[key]
+                    for key in PASS_HEADERS
+                    if key in response.headers
+                }
+                # iter_content() decodes Content-Encoding; the upstream length
+                # is only the length we write if there is none
+                if response.headers.get("Content-Encoding", "identity") != "identity":
+                    headers.pop("Content-Length", None)
+                with download.condition:
+                    download.headers = headers
+                    download.condition.notify_all()
+
+                with download.temp_path.open("wb") as out:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        out.write(chunk)
+                        out.flush()
+                        hash.update(chunk)
+                        with download.condition:
+                            download.written += len(chunk)
+                            download.condition.notify_all()
+
+            length = download.headers.get("Content-Length")
+            if length is not None and int(length) != download.written:
+                raise ChecksumError(
+                    f"{url} length {download.written} != Content-Length {length}"
+                )
+            if hash.hexdigest() != sha256:
+                raise ChecksumError(f"{url} sha256 {hash.hexdigest()} != {sha256}")
+
+            download.path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(download.temp_path, download.path)
+            self._add(relpath, download.written)
+            log.info("Cached %s", relpath)
+
+        except Exception as e:
+            log.warning("Download of %s failed: %s", url, e)
+            download.error = e
+            download.temp_path.unlink(missing_ok=True)
+
+        finally:
+            with self.lock:
+                del self.downloads[relpath]
+            with download.condition:
+                download.done = True
+                download.condition.notify_all()
+
+    def _add(self, relpath, size):
+        with self.lock:
+            self.size -= self.files.pop(relpath, 0)
+            self.files[relpath] = size
+            self.size += size
+            while self.size > self.max_bytes and len(self.files) > 1:
+                evicted, evicted_size = self.files.popitem(last=False)
+                self.size -= evicted_size
+                log.info("Evict %s", evicted)
+                (self.directory / evicted).unlink(missing_ok=True)
@@ -11,11 +11,15 @@ import sqlite3
 import subprocess
 from pathlib import Path
 
-import jsonpatch
+import repodata_diff
+import squash
 import truncateable
 
 log = logging.getLogger(__name__)
 
+# PRAGMA user_version; stored patches are compact json since version 1
+SCHEMA_VERSION = 1
+
 
 def hash_func(data=b""):
     return hashlib.blake2b(data, digest_size=32)
@@ -49,17 +53,44 @@ def make_patches(file, cwd=None, from_revision=0):
             rev_bytes = b""
 
             if previous:
-                patch = jsonpatch.make_patch(previous["obj"], current["obj"])
+                patch = repodata_diff.make_patch(previous["obj"], current["obj"])
                 patchobj = {
                     "to": current["digest"],
                     "from": previous["digest"],
-                    "patch": patch.patch,
+                    "patch": patch,
                 }
                 yield (rev_log, file, patchobj)
 
             previous = current
 
 
+def compact(text):
+    """
+    Re-serialize json text as compact json, as written to .jlap files.
+    """
+    return squash.dumps(json.loads(text)).decode("utf-8")
+
+
+def migrate(conn):
+    """
+    Upgrade stored patches to SCHEMA_VERSION.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    log.info("Migrate patches from version %d to %d", version, SCHEMA_VERSION)
+    with conn:
+        for table in ("patches", "squashed"):
+            for rowid, patch in conn.execute(
+                f"SELECT rowid, patch FROM {table} WHERE patch IS NOT NULL"
+            ).fetchall():
+                conn.execute(
+                    f"UPDATE {table} SET patch = ? WHERE rowid = ?",
+                    (compact(patch), rowid),
+                )
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
 def store_patches(conn):
     """
     Store patches from per-subdir mercurial repositories into sqlite.
@@ -77,6 +108,19 @@ def store_patches(conn):
             timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL)
         """
     )
+    # squashed patches from checkpoints to latest; patch is NULL if a
+    # squashed patch would not be smaller
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS squashed
+            (url TEXT NOT NULL,
+            patch_from TEXT NOT NULL,
+            patch_to TEXT NOT NULL,
+            patch TEXT,
+            PRIMARY KEY (url, patch_from, patch_to))
+        """
+    )
+    migrate(conn)
 
     for repodata in itertools.chain(
         Path().rglob("**/repodata.json"), Path().rglob("**/current_repodata.json")
@@ -100,7 +144,11 @@ def store_patches(conn):
             with conn:
                 conn.execute(
                     "INSERT INTO patches (url, hg_rev_to, patch) VALUES (?, ?, ?)",
-                    (f"{base_url}/{file}", rev["rev"], json.dumps(patch)),
+                    (
+                        f"{base_url}/{file}",
+                        rev["rev"],
+                        squash.dumps(patch).decode("utf-8"),
+                    ),
                 )
 
         headers = None
@@ -115,39 +163,143 @@ def store_patches(conn):
         write_jlap(conn, base_url, repodata.name, headers=headers)
 
 
+def hg_cat(base_url, file, rev):
+    return subprocess.run(
+        ["hg", "cat", "-r", str(rev), file],
+        cwd=base_url,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+def squash_patches(conn, base_url, file, rows, latest):
+    """
+    Return serialized squashed patches to latest from checkpoints every
+    squash.CHECKPOINT_INTERVAL patches back from the end of rows.
+
+    rows: list of (truncateable.lazy_patch(), hg_rev_to), oldest first
+
+    Squashed patches are computed once, and kept in the squashed table until
+    latest changes.
+    """
+    url = f"{base_url}/{file}"
+    patches = [patch for patch, _ in rows]
+    latest_obj = None
+    squashed = []
+
+    for i in range(1, squash.MAX_CHECKPOINTS + 1):
+        index = len(rows) - 1 - i * squash.CHECKPOINT_INTERVAL
+        if index < 0:
+            break
+        checkpoint, rev = rows[index]
+        digest = checkpoint["to"]
+
+        row = conn.execute(
+            "SELECT patch FROM squashed "
+            "WHERE url = ? AND patch_from = ? AND patch_to = ?",
+            (url, digest, latest),
+        ).fetchone()
+
+        if row is None:
+            if latest_obj is None:
+                latest_bytes = hg_cat(base_url, file, rows[-1][1])
+                if hash_func(latest_bytes).hexdigest() != latest:
+                    log.warn("%s does not match latest patch; not squashing", url)
+                    return []
+                latest_obj = json.loads(latest_bytes)
+
+            rev_bytes = hg_cat(base_url, file, rev)
+            patch = None
+            if hash_func(rev_bytes).hexdigest() == digest:
+                patch = squash.squash(
+                    json.loads(rev_bytes),
+                    digest,
+                    latest_obj,
+                    latest,
+                    squash.steps_since(patches, digest),
+                )
+            log.info(f"squash {url} from {digest}: {bool(patch)}")
+            row = (squash.dumps(patch).decode("utf-8") if patch else None,)
+            with conn:
+                conn.execute(
+                    "INSERT INTO squashed (url, patch_from, patch_to, patch) "
+                    "VALUES (?, ?, ?, ?)",
+                    (url, digest, latest, row[0]),
+                )
+
+        if row[0]:
+            squashed.append(row[0].encode("utf-8"))
+
+    with conn:
+        conn.execute(
+            "DELETE FROM squashed WHERE url = ? AND patch_to != ?", (url, latest)
+        )
+
+    # oldest checkpoint first
+    squashed.reverse()
+    return squashed
+
+
 def write_jlap(conn, base_url, file, headers):
     outfile = Path(base_url, file).with_suffix(".jlap")
     outfile_temp = Path(base_url, file).with_suffix(".jlap.tmp")
     assert not str(outfile).endswith(".json")
-    with outfile_temp.open("wb+") as out:
-        writer = truncateable.JlapWriter(out)
-        latest_line = {}
-        for row in conn.execute(
-            "SELECT patch FROM patches WHERE url = ? ORDER BY hg_rev_to",
+    # stored patches are copied to the .jlap without being parsed
+    rows = [
+        (truncateable.lazy_patch(line.encode("utf-8")), rev)
+        for line, rev in conn.execute(
+            "SELECT patch, hg_rev_to FROM patches WHERE url = ? ORDER BY hg_rev_to",
             (f"{base_url}/{file}",),
-        ):
-            line = row[0]
-            # TODO add non-reparsing writer
-            latest_line = json.loads(line)
-            writer.write(latest_line)
-
-        latest = latest_line.get("to")
-        if not latest_line.get("to"):
-            # we like big buffers
-            latest = hash_func(Path(base_url, file).read_bytes()).digest().hex()
-
-        writer.write(
-            {
-                "url": f"https://{base_url}/{file}",
-                "latest": latest,
-                "headers": headers,
-            }
         )
+    ]
+    latest_line = rows[-1][0] if rows else {}
+
+    latest = latest_line.get("to")
+    if not latest_line.get("to"):
+        # we like big buffers
+        latest = hash_func(Path(base_url, file).read_bytes()).digest().hex()
+
+    metadata = {
+        "url": f"https://{base_url}/{file}",
+        "latest": latest,
+        "headers": headers,
+    }
+
+    # append rows after the old latest revision, if it is in rows
+    if outfile.exists():
+        with outfile.open("rb") as fp, truncateable.JlapLines(fp) as jlap:
+            old_metadata = jlap.metadata()
+        if old_metadata == metadata:
+            return
+        digests = [patch["to"] for patch, _ in rows]
+        if old_metadata.get("latest") in digests:
+            start = digests.index(old_metadata["latest"]) + 1
+            truncateable.append_lines(
+                outfile,
+                (patch["raw"] for patch, _ in rows[start:]),
+                metadata,
+                squash_patches(conn, base_url, file, rows, latest),
+            )
+            log.info("Append %d patches to %s", len(rows) - start, outfile)
+            return
+
+    squashed = squash_patches(conn, base_url, file, rows, latest)
+    patches = [patch["raw"] for patch, _ in rows]
+    with outfile_temp.open("wb+") as out:
+        writer = truncateable.JlapWriter(out)
+        # squashed patches go just before the final patch
+        for line in patches[:-1]:
+            writer.write_raw(line)
+        tail = writer.position()
+        for line in squashed + patches[-1:]:
+            writer.write_raw(line)
+        writer.write(metadata)
         writer.finish()
 
     if not outfile.exists() or outfile_temp.read_bytes() != outfile.read_bytes():
         log.info("Overwrite changed %s", outfile)
         outfile_temp.replace(outfile)
+        truncateable.write_state(outfile, tail)
 
 
 if __name__ == "__main__":
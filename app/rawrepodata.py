@@ -0,0 +1,211 @@
+"""
+repodata.json with each package record kept as serialized json bytes.
+
+Patches decode only the records they touch, and serializing splices the bytes
+back together, instead of building millions of Python objects for all of
+repodata.json.
+
+dumps() writes one record per line, which loads() can index without parsing
+the records:
+
+    {"info":{"subdir":"noarch"},"repodata_version":1,
+    "packages":{
+    "a-1.0-0.tar.bz2":{"name":"a",...},
+    "b-1.0-0.tar.bz2":{"name":"b",...}
+    },
+    "packages.conda":{
+    }
+    }
+"""
+
+from __future__ import annotations
+
+import json
+
+import fastpatch
+
+SECTIONS = ("packages", "packages.conda")
+
+
+def dumps_compact(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def unescape(token: str):
+    """
+    Decode one JSON pointer token.
+    """
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def escape(token: str):
+    """
+    Encode one JSON pointer token.
+    """
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+class RawRepodata:
+    """
+    repodata.json as a dict of non-package keys, plus a dict of serialized
+    records for each of SECTIONS.
+    """
+
+    def __init__(self, other: dict, sections: dict[str, dict[str, bytes]]):
+        self.other = other
+        self.sections = sections
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        other = {key: value for key, value in data.items() if key not in SECTIONS}
+        sections = {
+            name: {
+                filename: dumps_compact(record)
+                for filename, record in data[name].items()
+            }
+            for name in SECTIONS
+            if name in data
+        }
+        return cls(other, sections)
+
+    @classmethod
+    def loads(cls, buf: bytes):
+        """
+        Parse output of dumps(), or any other json by way of from_dict().
+        """
+        try:
+            return cls._loads_lines(buf)
+        except (ValueError, IndexError):
+            return cls.from_dict(json.loads(buf))
+
+    @classmethod
+    def _loads_lines(cls, buf: bytes):
+        lines = iter(buf.split(b"\n"))
+        first = next(lines)
+        if not first.startswith(b"{"):
+            raise ValueError("not dumps() format")
+        other = json.loads(b"{" + first[1:].rstrip(b",") + b"}")
+
+        sections = {}
+        records = None
+        for line in lines:
+            if records is None:
+                if line == b"}":
+                    return cls(other, sections)
+                if not line.endswith(b":{"):
+                    raise ValueError("expected section", line[:64])
+                records = sections[json.loads(line[:-2])] = {}
+            elif line in (b"}", b"},"):
+                records = None
+            else:
+                if line.endswith(b","):
+                    line = line[:-1]
+                end = line.index(b'":') + 1
+                key = line[:end]
+                if b"\\" in key:
+                    filename = json.loads(key)
+                else:
+                    filename = key[1:-1].decode("utf-8")
+                records[filename] = line[end + 1 :]
+
+        raise ValueError("truncated")
+
+    def dumps(self) -> bytes:
+        head = dumps_compact(self.other)[1:-1]
+        lines = [b"{" + head + (b"," if head and self.sections else b"")]
+        for i, (name, records) in enumerate(self.sections.items()):
+            lines.append(dumps_compact(name) + b":{")
+            lines.append(
+                b",\n".join(
+                    dumps_compact(filename) + b":" + record
+                    for filename, record in records.items()
+                )
+            )
+            lines.append(b"}," if i < len(self.sections) - 1 else b"}")
+        lines.append(b"}")
+        return b"\n".join(line for line in lines if line)
+
+    def to_dict(self):
+        data = dict(self.other)
+        for name, records in self.sections.items():
+            data[name] = {
+                filename: json.loads(record) for filename, record in records.items()
+            }
+        return data
+
+    def apply_patch(self, ops: list):
+        """
+        Apply a list of json patch operations.
+
+        Operations on a single package record decode and re-encode only that
+        record. Operations spanning records, such as a move or copy between
+        records, fall back to patching the entire document.
+        """
+        grouped: dict[tuple, list] = {}
+        for op in ops:
+            target = self._target(op)
+            if target is None:
+                self._apply_slow(ops)
+                return
+            grouped.setdefault(target, []).append(op)
+
+        # ops on different records commute; order is kept within a record
+        for target, record_ops in grouped.items():
+            if target == ():
+                self.other = fastpatch.apply_patch(self.other, record_ops)
+            else:
+                self._apply_record(target, record_ops)
+
+    def _target(self, op):
+        """
+        Return (section, filename) touched by op, () for non-package keys, or
+        None if op must be applied to the entire document.
+        """
+        target = self._path_target(op["path"])
+        if op["op"] in ("move", "copy") and self._path_target(op["from"]) != target:
+            # between records, or between a record and other keys
+            return None
+        return target
+
+    def _path_target(self, path: str):
+        """
+        Return (section, filename) containing JSON pointer path, () for
+        non-package keys, or None for the whole document or a whole section.
+        """
+        if path == "":
+            return None
+        parts = path.split("/")
+        top = unescape(parts[1])
+        if top not in SECTIONS:
+            return ()
+        if len(parts) < 3 or top not in self.sections:
+            return None
+        return (top, unescape(parts[2]))
+
+    def _apply_record(self, target, ops):
+        section, filename = target
+        records = self.sections[section]
+        prefix = f"/{escape(section)}/{escape(filename)}"
+
+        # a one-element "document" holding the record, so that the patch can
+        # add, replace or remove the record itself
+        doc = {}
+        if filename in records:
+            doc["record"] = json.loads(records[filename])
+        relative = []
+        for op in ops:
+            op = dict(op, path="/record" + op["path"][len(prefix) :])
+            if "from" in op:
+                op["from"] = "/record" + op["from"][len(prefix) :]
+            relative.append(op)
+        doc = fastpatch.apply_patch(doc, relative)
+
+        if "record" in doc:
+            records[filename] = dumps_compact(doc["record"])
+        else:
+            records.pop(filename, None)
+
+    def _apply_slow(self, ops):
+        patched = RawRepodata.from_dict(fastpatch.apply_patch(self.to_dict(), ops))
+        self.other = patched.other
+        self.sections = patched.sections
@@ -0,0 +1,82 @@
+"""
+Diff repodata.json one package record at a time.
+
+jsonpatch.make_patch() walks both documents recursively, comparing every
+field of every record. Here "packages" and "packages.conda" are compared by
+filename and by record equality, which Python does without leaving C, and
+only records that changed are handed to jsonpatch. Applying the result gives
+the same document as applying jsonpatch.make_patch(src, dst).patch.
+"""
+
+from __future__ import annotations
+
+import jsonpatch
+
+SECTIONS = ("packages", "packages.conda")
+
+
+def escape(token: str):
+    """
+    Encode one JSON pointer token.
+    """
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def prefixed(ops: list, prefix: str):
+    """
+    Return json patch ops relative to the value at JSON pointer prefix.
+    """
+    result = []
+    for op in ops:
+        op = dict(op, path=prefix + op["path"])
+        if "from" in op:
+            op["from"] = prefix + op["from"]
+        result.append(op)
+    return result
+
+
+def diff_section(src: dict, dst: dict, prefix: str):
+    """
+    Return ops changing records in src into records in dst.
+    """
+    ops = []
+    for filename in src:
+        if filename not in dst:
+            ops.append({"op": "remove", "path": f"{prefix}/{escape(filename)}"})
+    for filename, record in dst.items():
+        if filename not in src:
+            ops.append(
+                {"op": "add", "path": f"{prefix}/{escape(filename)}", "value": record}
+            )
+        elif src[filename] != record:
+            ops.extend(
+                prefixed(
+                    jsonpatch.make_patch(src[filename], record).patch,
+                    f"{prefix}/{escape(filename)}",
+                )
+            )
+    return ops
+
+
+def make_patch(src: dict, dst: dict) -> list:
+    """
+    Return list of json patch operations changing repodata src into dst.
+    """
+    if not (isinstance(src, dict) and isinstance(dst, dict)):
+        return jsonpatch.make_patch(src, dst).patch
+
+    ops = []
+    for key in src:
+        if key not in dst:
+            ops.append({"op": "remove", "path": f"/{escape(key)}"})
+    for key, value in dst.items():
+        path = f"/{escape(key)}"
+        if key not in src:
+            ops.append({"op": "add", "path": path, "value": value})
+        elif src[key] == value:
+            continue
+        elif key in SECTIONS and isinstance(src[key], dict) and isinstance(value, dict):
+            ops.extend(diff_section(src[key], value, path))
+        else:
+            ops.extend(prefixed(jsonpatch.make_patch(src[key], value).patch, path))
+    return ops
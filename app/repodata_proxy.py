@@ -14,24 +14,49 @@ $ conda install -c http://localhost:8080/conda.anaconda.org/conda-forge
 """
 
 import argparse
+import collections
 import contextlib
 import gzip
+import itertools
 import json
 import logging
 import mimetypes
+import mmap
+import multiprocessing
 import os.path
+import signal
+import socketserver
 import tempfile
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
 
 import appdirs
 import bottle
+import metrics
+import package_cache
+import rawrepodata
 import requests
 import sync_jlap
 import truncateable
 import update_conda_cache
-from bottle import HTTPError, HTTPResponse, parse_date, request, route, run
+from bottle import (
+    HTTPError,
+    HTTPResponse,
+    parse_date,
+    parse_range_header,
+    request,
+    route,
+    run,
+)
 from update_conda_cache import hash_func
 
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
 log = logging.getLogger(__name__)
 
 from pathlib import Path
@@ -42,17 +67,409 @@ MIRROR_URL = "https://repodata.fly.dev"
 
 CHUNK_SIZE = 1 << 14
 
+# total size of patched, compressed responses kept in memory
+MEMORY_CACHE_BYTES = 1 << 29
+
+# favor speed; the default gzip level 9 is several times slower than 6
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 9
+
+# Content-Encoding, in order of preference when the client accepts several
+ENCODINGS = ["zstd", "gzip", "identity"] if zstandard else ["gzip", "identity"]
+
 session = sync_jlap.make_session((CACHE_DIR / "jlap_cache.db"))
 
 sync = sync_jlap.SyncJlap(session, CACHE_DIR)
 
 
+class LRUCache:
+    """
+    Least-recently-used cache of bytes, capped by total size in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value: bytes):
+        with self.lock:
+            if key in self.data:
+                self.size -= len(self.data.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self.data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.data.popitem(last=False)
+                self.size -= len(evicted)
+
+
+response_cache = LRUCache(MEMORY_CACHE_BYTES)
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time. Concurrent callers with the same
+    key wait for, and share, the result of the call already in flight.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+
+        if leader:
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.calls[key]
+
+        return future.result()
+
+
+flights = SingleFlight()
+
+
+# seconds between background refreshes of requested repodata
+REFRESH_INTERVAL = 30
+
+# stop refreshing repodata that has not been requested for this many seconds
+REFRESH_MAX_IDLE = 86400
+
+# opt-in cache of package files; a package_cache.PackageCache
+packages = None
+
+PACKAGE_CACHE_BYTES = 1 << 36
+
+# compress additional encodings without holding up the response
+compressor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="compress")
+
+# upstream response headers kept in cache_info()
+INFO_HEADERS = ("ETag", "Last-Modified", "Cache-Control")
+
+# compressed responses are also kept on disk as repodata.<latest>.json.gz etc.
+VARIANT_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# CoordinatorClient in worker processes; see serve_workers()
+coordinator = None
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """
+    wsgiref server handling each request in a new thread.
+    """
+
+    daemon_threads = True
+
+
+class FileRange:
+    """
+    Readable part of an open file. Returned to bottle as a response body, it
+    becomes wsgi.file_wrapper(FileRange) and is sent with socket.sendfile().
+    """
+
+    def __init__(self, fp, offset=0, length=None):
+        self.fp = fp
+        self.offset = offset
+        if length is None:
+            length = os.fstat(fp.fileno()).st_size - offset
+        self.length = length
+        self.position = offset
+
+    @classmethod
+    def open(cls, path: Path):
+        return cls(path.open("rb"))
+
+    def __len__(self):
+        return self.length
+
+    def part(self, start, end):
+        """
+        Return FileRange for [start, end) relative to this range.
+        """
+        return FileRange(self.fp, self.offset + start, end - start)
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def read(self, size=-1):
+        remaining = self.offset + self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        self.fp.seek(self.position)
+        data = self.fp.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+class SendfileServerHandler(ServerHandler):
+    """
+    wsgiref handler that sends FileRange bodies without copying them through
+    Python.
+    """
+
+    connection = None
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        if not isinstance(filelike, FileRange) or self.connection is None:
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self.bytes_sent += self.connection.sendfile(
+            filelike.fp, filelike.offset, filelike.length
+        )
+        return True
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    WSGIRequestHandler using SendfileServerHandler.
+    """
+
+    def address_string(self):  # no reverse DNS lookups
+        return self.client_address[0]
+
+    def handle(self):
+        # as in WSGIRequestHandler.handle()
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.connection = self.connection
+        handler.run(self.server.get_app())
+
+
+class CoordinatorClient:
+    """
+    Call functions in the coordinator process from a worker process. Any
+    number of threads may wait on calls at the same time.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending = {}
+        threading.Thread(target=self._receive, name="coordinator", daemon=True).start()
+
+    def call(self, name, *args):
+        future = Future()
+        with self.lock:
+            call_id = next(self.ids)
+            self.pending[call_id] = future
+            self.conn.send((call_id, name, args))
+        return future.result()
+
+    def _receive(self):
+        while True:
+            try:
+                call_id, ok, value = self.conn.recv()
+            except EOFError:
+                log.error("Coordinator exited")
+                os._exit(1)
+            with self.lock:
+                future = self.pending.pop(call_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+class Refresher:
+    """
+    Keep requested repodata synced and patched in the background, so that
+    requests are answered from the latest ready snapshot while a newer one is
+    prepared (stale-while-revalidate) instead of waiting on the mirror.
+
+    refresh(server, path) prepares repodata and returns its "latest" hash.
+    """
+
+    def __init__(self, refresh, interval=REFRESH_INTERVAL, max_idle=REFRESH_MAX_IDLE):
+        self.refresh = refresh
+        self.interval = interval
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.ready = {}  # (server, path): {"latest", "refreshed", "requested"}
+        self.pinned = set()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="refresh")
+
+    def latest(self, server, path):
+        """
+        Return the latest ready hash for server, path, or None if unknown.
+
+        Schedule a background refresh if it is older than interval.
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.ready.get((server, path))
+            if state is None:
+                return None
+            state["requested"] = now
+            stale = now - state["refreshed"] >= self.interval
+        if stale:
+            self.schedule(server, path)
+        return state["latest"]
+
+    def update(self, server, path, latest):
+        """
+        Record that server, path has been prepared up to latest.
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.ready.setdefault((server, path), {"requested": now})
+            state.update(latest=latest, refreshed=now)
+
+    def pin(self, server, path):
+        """
+        Refresh server, path even if it is never requested.
+        """
+        with self.lock:
+            self.pinned.add((server, path))
+        self.schedule(server, path)
+
+    def schedule(self, server, path):
+        with self.lock:
+            if (server, path) in self.pending:
+                return
+            self.pending.add((server, path))
+        self.executor.submit(self._refresh, server, path)
+
+    def _refresh(self, server, path):
+        try:
+            self.update(server, path, self.refresh(server, path))
+        except Exception:
+            log.exception("Background refresh of %s/%s failed", server, path)
+        finally:
+            with self.lock:
+                self.pending.discard((server, path))
+
+    def run(self):
+        """
+        Refresh stale repodata forever; forget repodata nobody asks for.
+        """
+        while True:
+            time.sleep(min(self.interval, 10))
+            now = time.monotonic()
+            with self.lock:
+                for key, state in list(self.ready.items()):
+                    if (
+                        key not in self.pinned
+                        and now - state["requested"] > self.max_idle
+                    ):
+                        log.info("Stop refreshing idle %s/%s", *key)
+                        del self.ready[key]
+                due = [
+                    key
+                    for key, state in self.ready.items()
+                    if now - state["refreshed"] >= self.interval
+                ]
+                # pinned repodata whose first refresh failed
+                due.extend(self.pinned.difference(self.ready))
+            for server, path in due:
+                self.schedule(server, path)
+
+    def start(self):
+        threading.Thread(target=self.run, name="refresh", daemon=True).start()
+
+
+LABELS = ("channel", "file")
+
+PHASE_SECONDS = metrics.Histogram(
+    "repodata_phase_seconds",
+    "Time spent in each phase of preparing and serving repodata.json.",
+    LABELS + ("phase",),
+)
+PATCHES_APPLIED = metrics.Counter(
+    "repodata_patches_applied_total", "Patches applied to cached repodata.", LABELS
+)
+BYTES_SERVED = metrics.Counter(
+    "repodata_bytes_served_total",
+    "Size of repodata.json responses, before Range.",
+    LABELS + ("encoding",),
+)
+UPSTREAM_BYTES_SAVED = metrics.Counter(
+    "repodata_upstream_bytes_saved_total",
+    "Bytes received for repodata.json minus .jlap bytes received, for each update.",
+    LABELS,
+)
+CACHE_REQUESTS = metrics.Counter(
+    "repodata_cache_requests_total",
+    'Responses already prepared (result="hit") or computed (result="miss").',
+    LABELS + ("result",),
+)
+FULL_DOWNLOADS = metrics.Counter(
+    "repodata_full_downloads_total", "Full repodata.json downloads.", LABELS
+)
+REFETCHES = metrics.Counter(
+    "repodata_refetch_total",
+    "Cached repodata.json discarded because it was not in the patchset.",
+    LABELS,
+)
+
+
+def channel_labels(server, path):
+    """
+    Metrics labels for repodata.json at server/path.
+    """
+    channel, _, file = path.rpartition("/")
+    return {"channel": f"{server}/{channel}", "file": file}
+
+
 @contextlib.contextmanager
-def timeme(message=""):
+def timeme(message="", phase=None, labels=None):
     begin = time.time()
     yield
     end = time.time()
     log.debug(f"{message}{end-begin:0.02f}s")
+    if phase:
+        PHASE_SECONDS.observe(end - begin, phase=phase, **(labels or {}))
+
+
+@route("/metrics")
+def metrics_endpoint():
+    return HTTPResponse(
+        metrics.render(), **{"Content-Type": "text/plain; version=0.0.4"}
+    )
 
 
 @route("/")
@@ -66,9 +483,24 @@ def welcome():
     """
 
 
+def transfer_size(response):
+    """
+    Return bytes received for response, before any Content-Encoding is
+    decoded.
+    """
+    try:
+        size = response.raw.tell()
+    except AttributeError:
+        size = None
+    if not size:
+        size = int(response.headers.get("Content-Length", len(response.content)))
+    return size
+
+
 def fetch_repodata_json(server, path, cache_path):
     """
-    Fetch new repodata.json; cache to a gzip'd file.
+    Fetch new repodata.json; cache to a gzip'd file, with its hash in
+    cache_info().
 
     Return (path, digest)
     """
@@ -79,17 +511,82 @@ def fetch_repodata_json(server, path, cache_path):
         response = requests.get(upstream, stream=True)
         response.raise_for_status()
         hash = hash_func()
+        size = 0
         for chunk in response.iter_content(CHUNK_SIZE):
             hash.update(chunk)
+            size += len(chunk)
             compressed.write(chunk)
 
         cache_path.parent.mkdir(parents=True, exist_ok=True)
         compressed.close()
         os.replace(outfile.name, cache_path)
 
+    # where the local .jlap was when this repodata.json was fetched
+    _, jlap_path, _ = repodata_paths(server, path)
+    try:
+        jlap_position = jlap_path.stat().st_size
+        jlap_latest = jlap_metadata(jlap_path)["latest"]
+    except FileNotFoundError:
+        jlap_position = jlap_latest = None
+
+    write_cache_info(
+        cache_path,
+        {
+            "url": upstream,
+            "blake2_256": hash.digest().hex(),
+            "size": size,
+            # usually gzip-encoded, unlike size
+            "transfer_size": transfer_size(response),
+            "headers": {
+                key: response.headers[key]
+                for key in INFO_HEADERS
+                if key in response.headers
+            },
+            "jlap_position": jlap_position,
+            "jlap_latest": jlap_latest,
+        },
+    )
+
     return cache_path, hash.digest()
 
 
+def cache_info_path(cache_path: Path):
+    """
+    Path to metadata about cache_path.
+    """
+    return cache_path.with_suffix(".info.json")
+
+
+def write_cache_info(cache_path: Path, info: dict):
+    """
+    Save info about cache_path, which is only valid while cache_path has the
+    same mtime and size.
+    """
+    stat = cache_path.stat()
+    info = dict(info, mtime_ns=stat.st_mtime_ns, size_gzip=stat.st_size)
+    path = cache_info_path(cache_path)
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as out:
+        json.dump(info, out)
+    os.replace(out.name, path)
+
+
+def cache_info(cache_path: Path):
+    """
+    Return info from write_cache_info(), or {} if missing or out of date.
+    """
+    try:
+        info = json.loads(cache_info_path(cache_path).read_text())
+        stat = cache_path.stat()
+    except (FileNotFoundError, ValueError):
+        return {}
+    if (info.get("mtime_ns"), info.get("size_gzip")) != (
+        stat.st_mtime_ns,
+        stat.st_size,
+    ):
+        return {}
+    return info
+
+
 class DigestReader:
     """
     Read and hash at the same time.
@@ -105,36 +602,474 @@ class DigestReader:
         return buf
 
 
-def apply_patches(cache_path: Path, jlap_path):
+def jlap_metadata(jlap_path: Path):
     """
-    Return patched version of cache_path, as an object
+    Return the metadata (next-to-last) line of a .jlap file, as an object.
+    """
+    with jlap_path.open("rb") as fp, truncateable.JlapLines(fp) as jlap:
+        return jlap.metadata()
+
+
+def snapshot_path(cache_path: Path):
+    """
+    Path to the last patched version of cache_path.
+    """
+    return cache_path.with_suffix(".snapshot.json")
+
+
+def read_snapshot(path: Path):
+    """
+    Return (RawRepodata, hash) from a snapshot written by write_snapshot().
+
+    Snapshots are uncompressed RawRepodata.dumps() output, which loads without
+    parsing each package record. The first line is the hash of the upstream
+    repodata.json that the snapshot is equivalent to.
+    """
+    buf, digest = read_snapshot_bytes(path)
+    return rawrepodata.RawRepodata.loads(buf), digest
+
+
+def snapshot_hash(path: Path):
+    """
+    Return hash from the first line of a snapshot, or None if missing.
+    """
+    try:
+        with path.open("rb") as fp:
+            return fp.readline().rstrip(b"\n").decode("utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def read_snapshot_bytes(path: Path):
+    """
+    Return (serialized json, hash) from a snapshot without parsing it.
+    """
+    with path.open("rb") as fp:
+        digest = fp.readline().rstrip(b"\n").decode("utf-8")
+        return fp.read(), digest
+
+
+def snapshot_body(path: Path, digest: str):
+    """
+    Return FileRange of the json in snapshot at path if its hash is digest.
+    """
+    try:
+        fp = path.open("rb")
+    except FileNotFoundError:
+        return None
+    if fp.readline().rstrip(b"\n").decode("utf-8") != digest:
+        fp.close()
+        return None
+    return FileRange(fp, fp.tell())
+
+
+def write_snapshot(path: Path, buf: bytes, digest: str):
+    """
+    Atomically replace snapshot at path with serialized json buf.
+    """
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as out:
+        out.write(digest.encode("utf-8") + b"\n")
+        out.write(buf)
+    os.replace(out.name, path)
+
+
+def variant_path(cache_path: Path, latest: str, encoding):
     """
-    jlap_lines = []
-    with jlap_path.open("rb") as fp:
-        jlap = truncateable.JlapReader(fp)
-        jlap_lines = list(obj for obj, _ in jlap.readobjs())
-        assert "latest" in jlap_lines[-1]
+    Path to repodata compressed in encoding, patched up to latest.
 
-    meta = jlap_lines[-1]
-    patches = jlap_lines[:-1]
-    digest_reader = DigestReader(gzip.open(cache_path))
-    original = json.load(digest_reader)
-    assert digest_reader.read() == b""
-    original_hash = digest_reader.hash.digest().hex()
+    These files are written once and never changed, so any process may send
+    them while newer ones are written.
+    """
+    stem = cache_path.name[: -len(".json.gz")]
+    return cache_path.with_name(f"{stem}.{latest}.json{VARIANT_SUFFIXES[encoding]}")
+
+
+def variant_body(cache_path: Path, latest: str, encoding):
+    """
+    Return FileRange of compressed repodata written by publish_variant(), or
+    None if missing.
+    """
+    try:
+        return FileRange.open(variant_path(cache_path, latest, encoding))
+    except FileNotFoundError:
+        return None
+
+
+def publish_variant(cache_path: Path, latest: str, encoding, body: bytes):
+    """
+    Write compressed repodata to variant_path(), removing older versions.
+    """
+    path = variant_path(cache_path, latest, encoding)
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as out:
+        out.write(body)
+    os.replace(out.name, path)
+
+    # files already opened for a response stay readable after unlink()
+    stem = cache_path.name[: -len(".json.gz")]
+    for old in path.parent.glob(f"{stem}.*.json{VARIANT_SUFFIXES[encoding]}"):
+        if old != path:
+            old.unlink(missing_ok=True)
+
+
+def ready_body(key, encoding, cache_path: Path):
+    """
+    Return finished response for key in encoding from memory or disk, or
+    None.
+    """
+    _, _, latest = key
+    if encoding == "identity":
+        return snapshot_body(snapshot_path(cache_path), latest)
+    body = response_cache.get(key + (encoding,))
+    if body is None:
+        body = variant_body(cache_path, latest, encoding)
+    return body
+
+
+def repodata_paths(server, path):
+    """
+    Return (.jlap url, local .jlap path, cache path) for repodata.json at
+    server/path.
+    """
+    jlap_url = f"{MIRROR_URL}/{server}/{path[:-len('.json')]}.jlap"
+    cache_path = Path(CACHE_DIR / server / path).with_suffix(".json.gz")
+    return jlap_url, sync.local_path(jlap_url), cache_path
+
+
+def fetch_if_missing(server, path, cache_path):
+    """
+    Fetch repodata.json unless it is already cached.
+    """
+    if not cache_path.exists():
+        FULL_DOWNLOADS.inc(**channel_labels(server, path))
+        cache_path, digest = fetch_repodata_json(server, path, cache_path)
+        assert digest  # check exists in patch file...
+
+
+def update_jlap(server, path):
+    """
+    Sync .jlap for repodata.json at server/path; return local path.
+    """
+    if coordinator:
+        # only the coordinator writes .jlap files
+        return Path(coordinator.call("update_jlap", server, path))
+    jlap_url, _, _ = repodata_paths(server, path)
+    with timeme("Sync ", "sync", channel_labels(server, path)):
+        return flights.do(jlap_url, sync.update_url, jlap_url)
+
+
+def record_sync(url, response):
+    """
+    Count upstream bytes saved by fetching new patches instead of the whole
+    repodata.json, as received when it was last fetched.
+    """
+    # no new patches if only the metadata and trailer lines were sent
+    if response.status_code != 206 or response.content.count(b"\n") < 2:
+        return
+    server, _, path = url[len(MIRROR_URL) + 1 :].partition("/")
+    path = path[: -len(".jlap")] + ".json"
+    _, _, cache_path = repodata_paths(server, path)
+    full_size = cache_info(cache_path).get("transfer_size")
+    if full_size is None:
+        return
+    UPSTREAM_BYTES_SAVED.inc(
+        max(full_size - transfer_size(response), 0), **channel_labels(server, path)
+    )
+
+
+sync.on_response = record_sync
+
+
+def apply_patches(cache_path: Path, jlap_path, labels=None):
+    """
+    Return (patched version of cache_path as RawRepodata, hash of patched data)
+
+    labels: metrics labels from channel_labels()
+
+    Start from the last snapshot if there are patches from it to "latest", so
+    that only patches newer than the snapshot are applied.
+    """
+    # parse only the patches that will be applied
+    with jlap_path.open("rb") as fp, truncateable.JlapLines(fp) as jlap:
+        *patch_lines, meta_line = list(jlap)
+
+    meta = meta_line.obj()
+    assert "latest" in meta
+    index = update_conda_cache.PatchIndex(
+        [truncateable.lazy_patch(line.raw) for line in patch_lines],
+        weigh=update_conda_cache.weigh_raw,
+    )
+
+    snapshot = snapshot_path(cache_path)
+    chain = index.plan(snapshot_hash(snapshot), meta["latest"])
+    if chain is not None:
+        with timeme("Load ", "load", labels):
+            original, original_hash = read_snapshot(snapshot)
+        log.debug("Patch from snapshot %s", original_hash)
+    else:
+        if snapshot.exists():
+            log.info(f"Remove {snapshot} not found in patchset")
+            snapshot.unlink()
+
+        with timeme("Load ", "load", labels):
+            original_hash = cache_info(cache_path).get("blake2_256")
+            if original_hash:
+                with gzip.open(cache_path) as fp:
+                    original = rawrepodata.RawRepodata.from_dict(json.load(fp))
+            else:
+                # cached before .info.json was written
+                digest_reader = DigestReader(gzip.open(cache_path))
+                original = rawrepodata.RawRepodata.from_dict(json.load(digest_reader))
+                assert digest_reader.read() == b""
+                original_hash = digest_reader.hash.digest().hex()
+                write_cache_info(cache_path, {"blake2_256": original_hash})
+
+        chain = index.plan(original_hash, meta["latest"])
 
     # XXX improve cache / re-download full file using standard cache rules
-    if (original_hash != meta["latest"]) and not any(
-        original_hash == patch["from"] for patch in patches
-    ):
-        log.info(
-            f"Remove {cache_path} not found in patchset; {original_hash == meta['latest']} and not any 'from' hash"
-        )
+    if chain is None:
+        log.info(f"Remove {cache_path}; no patches from {original_hash}")
         cache_path.unlink()
+        cache_info_path(cache_path).unlink(missing_ok=True)
+        REFETCHES.inc(**(labels or {}))
+        return original, original_hash
+
+    PATCHES_APPLIED.inc(len(chain), **(labels or {}))
+
+    with timeme("Patch ", "patch", labels):
+        for patch in chain:
+            original.apply_patch(json.loads(patch["raw"])["patch"])
+    return original, meta["latest"]
+
+
+def patched_json(key, cache_path: Path, jlap_path: Path):
+    """
+    Return (patched repodata as json bytes, True if patched up to "latest").
+
+    key is (server, path, latest).
+    """
+    server, path, latest = key
+    labels = channel_labels(server, path)
 
-    patched = update_conda_cache.apply_patches(
-        original, patches, original_hash, meta["latest"]
+    snapshot = snapshot_path(cache_path)
+    if snapshot_hash(snapshot) == latest:
+        buf, _ = read_snapshot_bytes(snapshot)
+        return buf, True
+
+    log.debug("serve %s", cache_path)
+
+    new_data, new_hash = apply_patches(cache_path, jlap_path, labels)
+
+    with timeme("Serialize ", "serialize", labels):
+        buf = new_data.dumps()
+
+    if new_hash != latest:
+        return buf, False
+
+    write_snapshot(snapshot, buf, latest)
+
+    return buf, True
+
+
+def compress(buf: bytes, encoding):
+    """
+    Return buf compressed with a Content-Encoding from ENCODINGS.
+    """
+    if encoding == "zstd":
+        # threads=-1 compresses chunks in parallel on all cores
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).compress(buf)
+    elif encoding == "gzip":
+        return gzip.compress(buf, compresslevel=GZIP_LEVEL)
+    return buf
+
+
+def negotiate_encoding(accept_encoding, encodings=ENCODINGS):
+    """
+    Return the best of encodings according to an Accept-Encoding header.
+
+    Ties go to the earlier encoding. identity is acceptable unless refused;
+    return None if every encoding is refused.
+    """
+    if accept_encoding is None:
+        return "identity"
+
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qvalues[name] = q
+
+    def quality(encoding):
+        if encoding in qvalues:
+            return qvalues[encoding]
+        if "*" in qvalues:
+            return qvalues["*"]
+        # acceptable, but only when nothing else is
+        return 0.001 if encoding == "identity" else 0.0
+
+    best = max(
+        encodings, key=lambda encoding: (quality(encoding), -encodings.index(encoding))
     )
-    return patched
+    if quality(best) <= 0:
+        return None
+    return best
+
+
+def cache_variant(key, encoding, buf: bytes):
+    """
+    Return buf in encoding, keeping compressed variants in memory and on disk.
+    """
+    server, path, latest = key
+    variant = key + (encoding,)
+    body = response_cache.get(variant)
+    if body is None:
+        with timeme(f"Compress {encoding} ", "compress", channel_labels(server, path)):
+            body = compress(buf, encoding)
+        if encoding != "identity":
+            response_cache.put(variant, body)
+            _, _, cache_path = repodata_paths(server, path)
+            publish_variant(cache_path, latest, encoding, body)
+    return body
+
+
+def encoded_response(key, encoding, cache_path: Path, jlap_path: Path):
+    """
+    Return (patched repodata in encoding, True if patched up to "latest").
+
+    key is (server, path, latest). The other encodings are compressed in the
+    background. Only complete responses are cached.
+    """
+    body = response_cache.get(key + (encoding,))
+    if body is not None:
+        return body, True
+
+    buf, complete = flights.do(key, patched_json, key, cache_path, jlap_path)
+
+    if not complete:
+        return compress(buf, encoding), False
+
+    # cache_variant() flights return bytes; keep them apart from the
+    # (body, complete) flights for key + (encoding,)
+    compress_key = ("compress",) + key
+    for other in ENCODINGS:
+        if other not in (encoding, "identity"):
+            compressor.submit(
+                flights.do, compress_key + (other,), cache_variant, key, other, buf
+            )
+
+    body = flights.do(compress_key + (encoding,), cache_variant, key, encoding, buf)
+    return body, True
+
+
+def package_sha256(server, path):
+    """
+    Return sha256 of the package at server/path according to the cached
+    repodata.json snapshot for its subdir, or None if unknown.
+    """
+    subdir, _, filename = path.rpartition("/")
+    _, _, cache_path = repodata_paths(server, f"{subdir}/repodata.json")
+    try:
+        fp = snapshot_path(cache_path).open("rb")
+    except FileNotFoundError:
+        return None
+
+    # find the record's line without parsing all of repodata.json
+    with fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        key = b"\n" + rawrepodata.dumps_compact(filename) + b":"
+        start = data.find(key)
+        if start == -1:
+            return None
+        start += len(key)
+        end = data.find(b"\n", start)
+        record = json.loads(data[start:end].rstrip(b","))
+
+    return record.get("sha256") if isinstance(record, dict) else None
+
+
+def serve_package(server, path):
+    """
+    Return response for a package file from the package cache, or None to
+    redirect upstream.
+    """
+    relpath = f"{server}/{path}"
+    cached = packages.lookup(relpath)
+    if not cached:
+        sha256 = package_sha256(server, path)
+        if not sha256:
+            return None
+        # finds a file cached since lookup() under the same lock that starts
+        # the download
+        cached, download = packages.fetch(relpath, f"https://{server}/{path}", sha256)
+
+    if cached:
+        log.debug("serve %s from package cache", relpath)
+        response = static_file_headers(
+            relpath, root=packages.directory, mimetype="application/octet-stream"
+        )
+        if response.status_code != 200:
+            return response
+        return ranged_response(FileRange.open(cached), dict(response.headers))
+
+    try:
+        headers = download.wait_headers()
+    except Exception:
+        return None
+
+    return HTTPResponse(download.follow(), **headers)
+
+
+def prepare(server, path):
+    """
+    Sync .jlap, then patch and compress repodata.json at server/path ahead of
+    requests. Return "latest" hash.
+    """
+    _, _, cache_path = repodata_paths(server, path)
+    jlap_path = update_jlap(server, path)
+    latest = jlap_metadata(jlap_path)["latest"]
+
+    if not cache_path.exists():
+        flights.do(cache_path, fetch_if_missing, server, path, cache_path)
+
+    key = (server, path, latest)
+    for encoding in ENCODINGS:
+        if (
+            encoding != "identity"
+            and not variant_path(cache_path, latest, encoding).exists()
+        ):
+            variant = key + (encoding,)
+            flights.do(variant, encoded_response, key, encoding, cache_path, jlap_path)
+    if snapshot_hash(snapshot_path(cache_path)) != latest:
+        flights.do(key, patched_json, key, cache_path, jlap_path)
+
+    return latest
+
+
+refresher = Refresher(prepare)
+
+
+def ready_latest(server, path):
+    """
+    Return "latest" hash of repodata.json at server/path that requests are
+    answered with.
+    """
+    if coordinator:
+        return coordinator.call("ready_latest", server, path)
+
+    latest = refresher.latest(server, path)
+    if latest is None:
+        # first request; later ones are served while refreshing in background
+        jlap_path = update_jlap(server, path)
+        latest = jlap_metadata(jlap_path)["latest"]
+        refresher.update(server, path, latest)
+    return latest
 
 
 @route(r"/<server:re:(repo\.anaconda\.com|conda\.anaconda\.org)>/<path:path>")
@@ -144,6 +1079,22 @@ def mirror(server, path):
 
     upstream = f"https://{server}/{path}"
 
+    # mirrored patch files
+    if path.endswith("repodata.jlap"):
+        jlap_path = update_jlap(server, path[: -len(".jlap")] + ".json")
+        response = static_file_headers(
+            str(jlap_path.relative_to(CACHE_DIR)), root=CACHE_DIR
+        )
+        if response.status_code != 200:
+            return response
+        return ranged_response(FileRange.open(jlap_path), dict(response.headers))
+
+    # cache packages if enabled
+    if packages and path.endswith((".conda", ".tar.bz2")):
+        response = serve_package(server, path)
+        if response:
+            return response
+
     # find packages on original server
     if not path.endswith("repodata.json"):
         response = bottle.response
@@ -154,53 +1105,158 @@ def mirror(server, path):
     # return cached repodata.json with latest patches applied
     assert path.endswith("repodata.json")
 
-    jlap_url = f"{MIRROR_URL}/{server}/{path[:-len('.json')]}.jlap"
-    jlap_path = sync.update_url(jlap_url)
+    labels = channel_labels(server, path)
+    with timeme("Serve ", "serve", labels):
+        return serve_repodata(server, path, labels)
 
-    cache_path = Path(CACHE_DIR / server / path).with_suffix(".json.gz")
-    if not cache_path.exists():
-        cache_path, digest = fetch_repodata_json(server, path, cache_path)
-        assert digest  # check exists in patch file...
 
-    # headers based on last modified of patch file
+def serve_repodata(server, path, labels, retry=True):
+    """
+    Return response for repodata.json at server/path with latest patches.
+    """
+    _, jlap_path, cache_path = repodata_paths(server, path)
+
+    encoding = negotiate_encoding(request.environ.get("HTTP_ACCEPT_ENCODING"))
+    if encoding is None:
+        raise HTTPError(406, "No acceptable Content-Encoding.")
+
+    # finished response is the same for every request until "latest" changes
+    latest = ready_latest(server, path)
+
+    # headers based on last modified of patch file; 304 without loading json
     response = static_file_headers(
-        str(jlap_path.relative_to(CACHE_DIR)), root=CACHE_DIR
+        str(jlap_path.relative_to(CACHE_DIR)),
+        root=CACHE_DIR,
+        etag=make_etag(latest, encoding),
     )
     del response.headers["Content-Length"]
+    response.headers["Vary"] = "Accept-Encoding"
 
     if response.status_code != 200:
         return response
 
-    log.debug("serve %s", cache_path)
+    key = (server, path, latest)
+    body = ready_body(key, encoding, cache_path)
+
+    CACHE_REQUESTS.inc(result="miss" if body is None else "hit", **labels)
+
+    if body is None and coordinator:
+        # wait for the coordinator to write the files for latest
+        if coordinator.call("prepare", server, path) != latest and retry:
+            return serve_repodata(server, path, labels, retry=False)
+        body = ready_body(key, encoding, cache_path)
+        if body is None:
+            raise HTTPError(
+                503, "Repodata not ready", **{"Retry-After": str(REFRESH_INTERVAL)}
+            )
+
+    elif body is None:
+        if not cache_path.exists():
+            flights.do(cache_path, fetch_if_missing, server, path, cache_path)
+        body, complete = flights.do(
+            key + (encoding,), encoded_response, key, encoding, cache_path, jlap_path
+        )
+        if not complete:
+            # not what the ETag promises
+            del response.headers["ETag"]
+        elif encoding == "identity":
+            # send the freshly written snapshot from disk
+            body = snapshot_body(snapshot_path(cache_path), latest) or body
+    else:
+        log.debug("serve %s %s from cache", cache_path, encoding)
 
-    with timeme("Patch "):
-        new_data = apply_patches(cache_path, jlap_path)
+    headers = dict(response.headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
 
-    with timeme("Serialize "):
-        buf = json.dumps(new_data)
+    BYTES_SERVED.inc(len(body), encoding=encoding, **labels)
 
-    patched_path = cache_path.with_suffix(".new.json.gz")
-    with gzip.open(patched_path, "wt") as out:
-        out.write(buf)
+    return ranged_response(body, headers)
 
-    response = HTTPResponse(
-        body=open(patched_path, "rb"),
-        status=200,
-        headers={
-            "Content-Length": patched_path.stat().st_size,
-            "Content-Encoding": "gzip",
-        },
-        **response.headers,
-    )
 
-    return response
+def if_range_matches(if_range, headers):
+    """
+    Return True if If-Range names the representation described by headers:
+    its strong ETag, or its Last-Modified date, compared exactly.
+    """
+    # bottle spells it "Etag"
+    validators = {name.lower(): value for name, value in headers.items()}
+    if if_range.startswith('"'):
+        etag = validators.get("etag", "")
+        return not etag.startswith("W/") and if_range == etag
+    # weak ETags never match
+    return if_range == validators.get("last-modified")
+
+
+def ranged_response(body, headers):
+    """
+    Return 200 response, or 206 if the request has a satisfiable Range.
+
+    body is bytes or a FileRange; headers are sent with either response.
+    """
+    size = len(body)
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Length"] = size
+
+    range_header = request.environ.get("HTTP_RANGE")
+    if_range = request.environ.get("HTTP_IF_RANGE")
+    if if_range and not if_range_matches(if_range, headers):
+        range_header = None  # representation changed; send all of it
+
+    if range_header:
+        ranges = list(parse_range_header(range_header, size))
+        if not ranges:
+            if isinstance(body, FileRange):
+                body.close()  # not sent, so bottle won't close it
+            return HTTPError(
+                416,
+                "Requested Range Not Satisfiable",
+                headers={"Content-Range": f"bytes */{size}"},
+            )
+        offset, end = ranges[0]
+        headers["Content-Range"] = f"bytes {offset}-{end - 1}/{size}"
+        headers["Content-Length"] = end - offset
+        if isinstance(body, FileRange):
+            body = body.part(offset, end)
+        else:
+            body = body[offset:end]
+        return HTTPResponse(body, status=206, **headers)
+
+    return HTTPResponse(body, **headers)
+
+
+def make_etag(latest, encoding="identity"):
+    """
+    Strong ETag for repodata patched up to the jlap "latest" hash.
+
+    Each Content-Encoding is a different representation with its own ETag.
+    """
+    if encoding == "identity":
+        return f'"{latest}"'
+    return f'"{latest}-{encoding}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Weak comparison of an If-None-Match header against etag.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
 
 
 def static_file_headers(
-    filename, root, mimetype="auto", download=False, charset="UTF-8"
+    filename, root, mimetype="auto", download=False, charset="UTF-8", etag=None
 ) -> bottle.BaseResponse:
     """
     bottle.static_file_headers but without opening file
+
+    If etag is given, If-None-Match takes precedence over If-Modified-Since.
     """
 
     root = os.path.abspath(root) + os.sep
@@ -233,6 +1289,17 @@ def static_file_headers(
     lm = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(stats.st_mtime))
     headers["Last-Modified"] = lm
 
+    if etag:
+        headers["ETag"] = etag
+        inm = request.environ.get("HTTP_IF_NONE_MATCH")
+        if inm is not None:
+            if etag_matches(inm, etag):
+                headers["Date"] = time.strftime(
+                    "%a, %d %b %Y %H:%M:%S GMT", time.gmtime()
+                )
+                return HTTPResponse(status=304, **headers)
+            return HTTPResponse("", **headers)
+
     ims = request.environ.get("HTTP_IF_MODIFIED_SINCE")
     if ims:
         ims = parse_date(ims.split(";")[0].strip())
@@ -240,34 +1307,156 @@ def static_file_headers(
         headers["Date"] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
         return HTTPResponse(status=304, **headers)
 
-    body = ""  # to be replaced
-
-    # headers["Accept-Ranges"] = "bytes"
-    # ranges = request.environ.get("HTTP_RANGE")
-    # if "HTTP_RANGE" in request.environ:
-    #     ranges = list(parse_range_header(request.environ["HTTP_RANGE"], clen))
-    #     if not ranges:
-    #         return HTTPError(416, "Requested Range Not Satisfiable")
-    #     offset, end = ranges[0]
-    #     headers["Content-Range"] = "bytes %d-%d/%d" % (offset, end - 1, clen)
-    #     headers["Content-Length"] = str(end - offset)
-    #     if body:
-    #         body = _file_iter_range(body, offset, end - offset)
-    #     return HTTPResponse(body, status=206, **headers)
+    body = ""  # to be replaced; see ranged_response()
 
     return HTTPResponse(body, **headers)
 
 
-def serve_cache(port=8080, bind="0.0.0.0"):
+# functions workers call in the coordinator
+COORDINATOR_CALLS = {
+    "ready_latest": ready_latest,
+    "prepare": prepare,
+    "update_jlap": lambda server, path: str(update_jlap(server, path)),
+}
+
+
+def coordinate(conn):
+    """
+    Answer calls from one worker, in the coordinator process.
+    """
+    lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="coordinate")
+
+    def answer(call_id, name, args):
+        try:
+            reply = (call_id, True, COORDINATOR_CALLS[name](*args))
+        except Exception as e:
+            log.exception("%s%s failed", name, args)
+            # the original may not pickle
+            reply = (call_id, False, RuntimeError(f"{name} failed: {e}"))
+        with lock:
+            conn.send(reply)
+
+    while True:
+        try:
+            call_id, name, args = conn.recv()
+        except EOFError:
+            return
+        executor.submit(answer, call_id, name, args)
+
+
+def serve_workers(server, workers):
+    """
+    Serve with worker processes.
+
+    This process is the coordinator: it alone syncs, patches and compresses
+    repodata, writing each version to files that are never changed afterwards.
+    Workers answer requests by sending those files, which are shared between
+    processes in the page cache, instead of each keeping its own copy of
+    repodata in memory.
+
+    Must be called before any threads are started.
+    """
+    global coordinator
+
+    children = {}
+    for _ in range(workers):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            coordinator = CoordinatorClient(child_conn)
+            # responses are sent from the coordinator's files
+            response_cache.max_bytes = 0
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        child_conn.close()
+        children[pid] = parent_conn
+
+    server.socket.close()
+    log.info("Started %d workers", workers)
+
+    for conn in children.values():
+        threading.Thread(
+            target=coordinate, args=(conn,), name="coordinate", daemon=True
+        ).start()
+
+    return children
+
+
+def serve_cache(
+    port=8080,
+    bind="0.0.0.0",
+    memory_cache=MEMORY_CACHE_BYTES,
+    refresh_interval=REFRESH_INTERVAL,
+    prefetch=(),
+    package_dir=None,
+    package_cache_size=PACKAGE_CACHE_BYTES,
+    workers=1,
+):
+    """
+    prefetch: "server/path" of repodata.json to keep refreshed even before it
+    is requested.
+
+    package_dir: cache package files here instead of redirecting upstream.
+
+    workers: if more than 1, serve from this many processes; see
+    serve_workers().
+    """
+    global packages
+
     CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
     log.info("Cache in %s", CACHE_DIR)
 
-    run(port=port, host=bind)
+    if package_dir:
+        packages = package_cache.PackageCache(package_dir, package_cache_size)
+
+    response_cache.max_bytes = memory_cache
+
+    children = {}
+    if workers > 1:
+        httpd = ThreadingWSGIServer((bind, port), RequestHandler)
+        httpd.set_app(bottle.default_app())
+        log.info("Listening on http://%s:%d/", bind, port)
+        children = serve_workers(httpd, workers)
+
+    refresher.interval = refresh_interval
+    for url in prefetch:
+        server, _, path = url.split("://", 1)[-1].partition("/")
+        refresher.pin(server, path)
+    refresher.start()
+
+    if not children:
+        # concurrent requests for the same repodata share one SingleFlight call
+        run(
+            port=port,
+            host=bind,
+            server_class=ThreadingWSGIServer,
+            handler_class=RequestHandler,
+        )
+        return
+
+    try:
+        while children:
+            pid, status = os.wait()
+            log.error("Worker %d exited with status %d", pid, status)
+            children.pop(pid, None)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
 
 
 def go():
-    for name in "__main__", "sync_jlap", "update_conda_cache", "repodata_proxy":
+    for name in (
+        "__main__",
+        "sync_jlap",
+        "update_conda_cache",
+        "repodata_proxy",
+        "package_cache",
+    ):
         logging.getLogger(name).setLevel(logging.DEBUG)
 
     logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%S")
@@ -289,9 +1478,71 @@ def go():
         help="Specify alternate bind address [default: all interfaces]",
     )
 
+    parser.add_argument(
+        "--memory-cache",
+        metavar="BYTES",
+        type=int,
+        default=MEMORY_CACHE_BYTES,
+        help="Keep up to BYTES of patched responses in memory "
+        f"[default: {MEMORY_CACHE_BYTES}]",
+    )
+
+    parser.add_argument(
+        "--refresh-interval",
+        metavar="SECONDS",
+        type=int,
+        default=REFRESH_INTERVAL,
+        help="Update requested repodata in the background this often "
+        f"[default: {REFRESH_INTERVAL}]",
+    )
+    parser.add_argument(
+        "--prefetch",
+        metavar="URL",
+        action="append",
+        default=[],
+        help="Keep repodata.json at URL e.g. "
+        "conda.anaconda.org/conda-forge/linux-64/repodata.json "
+        "ready before it is requested. May be repeated.",
+    )
+
+    parser.add_argument(
+        "--package-cache",
+        metavar="DIRECTORY",
+        help="Cache package files in DIRECTORY instead of redirecting upstream",
+    )
+    parser.add_argument(
+        "--package-cache-size",
+        metavar="BYTES",
+        type=int,
+        default=PACKAGE_CACHE_BYTES,
+        help=f"Maximum size of package cache [default: {PACKAGE_CACHE_BYTES}]",
+    )
+
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Serve requests from N processes, with patching done in one "
+        "coordinator process [default: 1]",
+    )
+
     args = parser.parse_args()
 
-    serve_cache(args.port, args.bind)
+    if args.workers > 1 and args.package_cache:
+        # each process would keep its own index of the cache
+        parser.error("--package-cache is not supported with --workers")
+
+    serve_cache(
+        args.port,
+        args.bind,
+        memory_cache=args.memory_cache,
+        refresh_interval=args.refresh_interval,
+        prefetch=args.prefetch,
+        package_dir=args.package_cache,
+        package_cache_size=args.package_cache_size,
+        workers=args.workers,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+"""
+Squashed patches from periodic checkpoints straight to "latest".
+
+A client that is far behind can apply one squashed patch instead of every
+patch since its revision, and redundant changes are coalesced: a package that
+was added, hot-fixed and then marked broken becomes a single add.
+
+Squashed patches are marked {"squash": true} and written just before the
+final patch to "latest". Clients that walk the file backwards from the end,
+following one "to" hash at a time, never reach them. Clients that plan a path
+by hash (update_conda_cache.PatchIndex) use them when they are cheaper.
+"""
+
+from __future__ import annotations
+
+import json
+
+import repodata_diff
+
+# squash from a checkpoint every this many patches
+CHECKPOINT_INTERVAL = 16
+
+# keep squashed patches from at most this many checkpoints
+MAX_CHECKPOINTS = 4
+
+
+def is_squashed(patch: dict):
+    return bool(patch.get("squash"))
+
+
+def genuine(patches: list[dict]):
+    """
+    Return patches without squashed patches.
+    """
+    return [patch for patch in patches if not is_squashed(patch)]
+
+
+def dumps(patch: dict):
+    return json.dumps(patch, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def steps(patch: dict):
+    """
+    Return number of steps in patch, or in truncateable.lazy_patch().
+    """
+    if "patch" not in patch:
+        return len(json.loads(patch["raw"])["patch"])
+    return len(patch["patch"])
+
+
+def steps_since(patches: list[dict], digest: str):
+    """
+    Return number of steps in the patches following digest to the end of
+    patches, or None if digest is not the "from" of any patch.
+    """
+    total = None
+    for patch in genuine(patches):
+        if patch["from"] == digest:
+            total = 0
+        if total is not None:
+            total += steps(patch)
+    return total
+
+
+def squash(
+    checkpoint_obj, checkpoint_digest: str, latest_obj, latest_digest: str, steps=None
+):
+    """
+    Return squashed patch from checkpoint to latest, or None if it would not
+    have fewer than steps steps.
+    """
+    patch = repodata_diff.make_patch(checkpoint_obj, latest_obj)
+    if steps is not None and len(patch) >= steps:
+        return None
+    return {
+        "to": latest_digest,
+        "from": checkpoint_digest,
+        "patch": patch,
+        "squash": True,
+    }
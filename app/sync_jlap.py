@@ -3,27 +3,47 @@
 Synchronize local patch files with repodata.fly.dev
 """
 
+import argparse
+import heapq
 import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import truncateable
 from no_cache import discard_serializer
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession
 
 log = logging.getLogger(__name__)
 
+# concurrent syncs, and connections kept open per host
+POOL_SIZE = 8
 
-def make_session(db_path="http_cache_jlap"):
+
+# poll each url at least, and at most, this often in daemon mode (seconds)
+MIN_INTERVAL = 15
+MAX_INTERVAL = 3600
+
+# requests per minute for all urls in daemon mode
+REQUEST_BUDGET = 60
+
+
+def make_session(db_path="http_cache_jlap", pool_size=POOL_SIZE, expire_after=30):
     session = CachedSession(
         str(db_path),
         allowable_codes=[200, 206],
         match_headers=["Accept", "Range"],
         serializer=discard_serializer,
         cache_control=True,
-        expire_after=30,  # otherwise cache only expires if response header says so
+        # otherwise cache only expires if response header says so
+        expire_after=expire_after,
     )
     session.headers["User-Agent"] = "update-conda-cache/0.0.1"
+    session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
     return session
 
 
@@ -49,22 +69,27 @@ def line_offsets(path: Path):
     """
     Return byte offset to next-to-last line in path.
     """
-    sum = 0
-    offsets = []
     with path.open("rb") as data:
-        for line in data:
-            offsets.append(sum)
-            sum += len(line)
-    try:
-        return offsets[-2]
-    except IndexError:
+        offsets = truncateable.tail_offsets(data, 2)
+    if len(offsets) < 2:
         return 0
+    return offsets[0]
 
 
 class SyncJlap:
-    def __init__(self, session, basedir):
+    def __init__(self, session, basedir, on_response=None):
+        """
+        on_response(url, response) is called after each network request.
+        """
         self.session = session
         self.basedir = basedir
+        self.on_response = on_response
+
+    def local_path(self, url):
+        """
+        Return path to local copy of .jlap file at url.
+        """
+        return Path(self.basedir, url.split("://", 1)[-1])
 
     def update_url(self, url):
         """
@@ -73,13 +98,15 @@ class SyncJlap:
         Return path to cached file.
         """
         session = self.session
-        output = Path(self.basedir, url.split("://", 1)[-1])
+        output = self.local_path(url)
         headers = {}
+        state = None
         if not output.exists():
             output.parent.mkdir(parents=True, exist_ok=True)
             headers = {"Cache-Control": "no-cache"}
         else:
-            offset = line_offsets(output)
+            state = truncateable.read_state(output)
+            offset = state[0] if state else line_offsets(output)
             headers = {"Range": "bytes=%d-" % offset}
 
         response = session.get(url, headers=headers)
@@ -87,6 +114,9 @@ class SyncJlap:
             log.debug(f"from_cache {url} expires {response.expires}")
             return output
 
+        if self.on_response:
+            self.on_response(url, response)
+
         log.debug(
             "%s %s %s %s",
             response.status_code,
@@ -95,13 +125,17 @@ class SyncJlap:
             response.headers,
         )
 
+        # build the new file beside the old one, then replace it, since
+        # readers may have the old one open or mapped
+        temp = output.with_name(output.name + ".tmp")
         if response.status_code == 200:
             log.info("Full download")
-            output.write_bytes(response.content)
+            temp.write_bytes(response.content)
+            state = None
         elif response.status_code == 206:
             size_before = os.stat(output).st_size
-            os.truncate(output, offset)
-            with output.open("ba") as out:
+            with output.open("rb") as fp, temp.open("wb") as out:
+                truncateable.copy_head(fp, out, offset)
                 tell = out.tell()
                 log.info(
                     "Append %d-%d (%d lines)",
@@ -110,7 +144,7 @@ class SyncJlap:
                     len(response.content.splitlines()),
                 )
                 out.write(response.content)
-            size_after = os.stat(output).st_size
+            size_after = os.stat(temp).st_size
             log.info(
                 "Was %d, now %d bytes, delta %d",
                 size_before,
@@ -119,30 +153,264 @@ class SyncJlap:
             )
         else:
             log.info("Unexpected status %d", response.status_code)
+            temp = output
 
-        # verify checksum
-        # can cache checksum of next-to-last line instead of recalculating all
-        # (remove consumed lines from local file and store full length)
-        with output.open("rb") as fp:
-            jlap = truncateable.JlapReader(fp)
-            for _obj in jlap.readobjs():
-                pass
+        # verify checksum, of only the new lines if the earlier ones were
+        # already verified
+        try:
+            with temp.open("rb") as fp:
+                state = truncateable.verify(fp, *(state or (0, None)))
+        except truncateable.JlapError:
+            truncateable.state_path(output).unlink(missing_ok=True)
+            if temp != output:
+                temp.unlink()
+            raise
+        if temp != output:
+            temp.replace(output)
+        truncateable.write_state(output, state)
 
         return output
 
+    def update_urls(self, urls, max_workers=POOL_SIZE):
+        """
+        Update several .jlap files at once; each is downloaded and verified on
+        its own thread.
+
+        Return {url: (seconds, path or exception)}.
+        """
+
+        def timed_update(url):
+            begin = time.monotonic()
+            try:
+                result = self.update_url(url)
+            except Exception as e:
+                result = e
+            return time.monotonic() - begin, result
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(timed_update, url): url for url in urls}
+            for future in as_completed(futures):
+                url = futures[future]
+                seconds, result = results[url] = future.result()
+                if isinstance(result, Exception):
+                    log.error("%s failed after %0.2fs: %s", url, seconds, result)
+                else:
+                    log.info("%s synced in %0.2fs", url, seconds)
+
+        return results
+
+
+def trailer(path: Path):
+    """
+    Return the summary hash (last line) of .jlap file at path, or None.
+    """
+    try:
+        with path.open("rb") as fp:
+            (offset,) = truncateable.tail_offsets(fp, 1)
+            fp.seek(offset)
+            return fp.read()
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class RequestBudget:
+    """
+    Allow at most per_minute requests per minute, spread evenly.
+    """
+
+    def __init__(self, per_minute=REQUEST_BUDGET):
+        self.spacing = 60 / per_minute
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.spacing
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Poller:
+    """
+    Keep .jlap files synced, polling each url about twice per observed
+    interval between changes: busy channels often, quiet channels rarely.
+
+    Each poll without a change backs off; each change moves the interval
+    toward half the time since the previous change. Polls are jittered so
+    urls don't synchronize, and limited by a shared RequestBudget.
+    """
+
+    BACKOFF = 1.5
+    JITTER = 0.1
+    # weight of the newest time between changes in the running estimate
+    SMOOTHING = 0.3
+
+    def __init__(
+        self,
+        sync: SyncJlap,
+        urls,
+        budget: RequestBudget,
+        min_interval=MIN_INTERVAL,
+        max_interval=MAX_INTERVAL,
+    ):
+        self.sync = sync
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.condition = threading.Condition()
+        now = time.monotonic()
+        self.state = {
+            url: {"interval": min_interval, "estimate": None, "changed": None}
+            for url in urls
+        }
+        # spread the first polls over one interval
+        self.queue = [
+            (now + random.uniform(0, min_interval), url) for url in self.state
+        ]
+        heapq.heapify(self.queue)
+
+    def clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def poll(self, url):
+        """
+        Sync url once; return True if it changed.
+        """
+        before = trailer(self.sync.local_path(url))
+        try:
+            path = self.sync.update_url(url)
+        except Exception as e:
+            log.error("Poll %s failed: %s", url, e)
+            return False
+        return trailer(path) != before
+
+    def reschedule(self, url, changed):
+        now = time.monotonic()
+        state = self.state[url]
+        if changed:
+            if state["changed"] is not None:
+                observed = now - state["changed"]
+                estimate = state["estimate"]
+                state["estimate"] = (
+                    observed
+                    if estimate is None
+                    else estimate + self.SMOOTHING * (observed - estimate)
+                )
+                state["interval"] = self.clamp(state["estimate"] / 2)
+            state["changed"] = now
+        else:
+            state["interval"] = self.clamp(state["interval"] * self.BACKOFF)
+
+        delay = state["interval"] * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+        log.info(
+            "%s %s; next poll in %ds",
+            url,
+            "changed" if changed else "unchanged",
+            delay,
+        )
+        with self.condition:
+            heapq.heappush(self.queue, (now + delay, url))
+            self.condition.notify()
+
+    def run(self, max_workers=POOL_SIZE):
+        """
+        Poll forever.
+        """
+
+        def poll_and_reschedule(url):
+            self.reschedule(url, self.poll(url))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                with self.condition:
+                    while True:
+                        due, url = self.queue[0] if self.queue else (None, None)
+                        now = time.monotonic()
+                        if due is not None and due <= now:
+                            heapq.heappop(self.queue)
+                            break
+                        self.condition.wait(None if due is None else due - now)
+                self.budget.wait()
+                executor.submit(poll_and_reschedule, url)
+
+
+def all_urls():
+    return [
+        f"https://{MIRROR}/{repo}/{subdir}/{file}"
+        for repo in REPOS
+        for subdir in SUBDIRS
+        for file in ("repodata.jlap", "current_repodata.jlap")
+    ]
+
 
 def update():
     sync = SyncJlap(make_session(), BASEDIR)
 
-    for repo in REPOS:
-        for subdir in SUBDIRS:
-            for url in [
-                f"https://{MIRROR}/{repo}/{subdir}/repodata.jlap",
-                f"https://{MIRROR}/{repo}/{subdir}/current_repodata.jlap",
-            ]:
-                sync.update_url(url)
+    urls = all_urls()
 
+    begin = time.monotonic()
+    results = sync.update_urls(urls)
+    failed = sum(isinstance(result, Exception) for _, result in results.values())
+    log.info(
+        "Synced %d files in %0.2fs, %d failed",
+        len(urls),
+        time.monotonic() - begin,
+        failed,
+    )
 
-if __name__ == "__main__":
+
+def daemon(budget=REQUEST_BUDGET, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    # the Poller decides when to ask again; always revalidate
+    sync = SyncJlap(make_session(expire_after=0), BASEDIR)
+    Poller(
+        sync,
+        all_urls(),
+        RequestBudget(budget),
+        min_interval=min_interval,
+        max_interval=max_interval,
+    ).run()
+
+
+def go():
     logging.basicConfig(level=logging.INFO)
-    update()
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running, polling busy channels more often than quiet ones",
+    )
+    parser.add_argument(
+        "--budget",
+        metavar="N",
+        type=int,
+        default=REQUEST_BUDGET,
+        help=f"Make at most N requests per minute [default: {REQUEST_BUDGET}]",
+    )
+    parser.add_argument(
+        "--min-interval",
+        metavar="SECONDS",
+        type=int,
+        default=MIN_INTERVAL,
+        help=f"Poll each file at most this often [default: {MIN_INTERVAL}]",
+    )
+    parser.add_argument(
+        "--max-interval",
+        metavar="SECONDS",
+        type=int,
+        default=MAX_INTERVAL,
+        help=f"Poll each file at least this often [default: {MAX_INTERVAL}]",
+    )
+    args = parser.parse_args()
+
+    if args.daemon:
+        daemon(args.budget, args.min_interval, args.max_interval)
+    else:
+        update()
+
+
+if __name__ == "__main__":
+    go()
@@ -15,13 +15,23 @@ The last line does not end with a line separator, so there is no blank line at
 the end of the file.
 """
 
+import itertools
 import json
+import mmap
+import os
+import re
 from hashlib import blake2b
 from io import BytesIO, IOBase
-from typing import Optional, Tuple
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple
 
 DIGEST_SIZE = 32  # 160 bits a minimum 'for security' length?
 MAX_LINEID_BYTES = 64
+TAIL_BLOCK_SIZE = 1 << 16
+
+# serialized patch beginning with its hashes, as written by JlapWriter
+PATCH_PREFIX = re.compile(rb'\{"to":"([0-9a-f]*)","from":"([0-9a-f]*)"')
+SQUASH_SUFFIX = b',"squash":true}'
 
 
 def hfunc(data: str, key: bytes):
@@ -113,26 +123,361 @@ class JlapReader:
                 yield obj
 
 
+class JlapLine(NamedTuple):
+    offset: int
+    raw: bytes  # without newline
+    lineid: Optional[bytes]  # summary hash including this line
+
+    def obj(self):
+        return json.loads(self.raw)
+
+
+class JlapLines:
+    """
+    .jlap file mapped into memory, read as raw lines without parsing json.
+
+        with JlapLines(fp) as jlap:
+            metadata = jlap.metadata()
+            for line in jlap:  # checks summary hash at the end
+                patch = line.obj()
+    """
+
+    def __init__(self, fp: IOBase):
+        self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        first = self.data.find(b"\n")
+        if first == -1:
+            raise JlapError("missing summary hash")
+        self.iv = bytes.fromhex(self.data[:first].decode("utf-8"))
+        assert len(self.iv) <= MAX_LINEID_BYTES
+        self.start = first + 1
+        self.trailer_offset = self.data.rfind(b"\n") + 1
+        self.trailer = self.data[self.trailer_offset :]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def __iter__(self) -> Iterator[JlapLine]:
+        """
+        Yield each line between the first and last lines, with its summary
+        hash. Raise JlapError at the end if the summary hash does not match.
+        """
+        lineid = self.iv
+        offset = self.start
+        while offset < self.trailer_offset:
+            end = self.data.find(b"\n", offset)
+            raw = self.data[offset:end]
+            lineid = bhfunc(raw, lineid).digest()
+            yield JlapLine(offset, raw, lineid)
+            offset = end + 1
+        if lineid.hex().encode("utf-8") != self.trailer:
+            raise JlapError("summary hash mismatch", lineid.hex(), self.trailer)
+
+    def reversed(self) -> Iterator[JlapLine]:
+        """
+        Yield lines from the end of the file backwards, without summary
+        hashes, which can only be computed from the start.
+        """
+        end = self.trailer_offset - 1
+        while end >= self.start:
+            offset = self.data.rfind(b"\n", self.start - 1, end) + 1
+            yield JlapLine(offset, self.data[offset:end], None)
+            end = offset - 1
+
+    def metadata(self):
+        """
+        Return the metadata (next-to-last) line, as an object.
+        """
+        return next(self.reversed()).obj()
+
+
+def lazy_patch(raw: bytes):
+    """
+    Return {"to", "from", "raw", "squash"} of a serialized patch line without
+    parsing its operations, which are json.loads(patch["raw"])["patch"].
+    """
+    match = PATCH_PREFIX.match(raw)
+    if match:
+        return {
+            "to": match[1].decode(),
+            "from": match[2].decode(),
+            "raw": raw,
+            "squash": raw.endswith(SQUASH_SUFFIX),
+        }
+    patch = json.loads(raw)
+    return {
+        "to": patch["to"],
+        "from": patch["from"],
+        "raw": raw,
+        "squash": bool(patch.get("squash")),
+    }
+
+
+def tail_offsets(fp: IOBase, lines=2, block_size=TAIL_BLOCK_SIZE) -> list:
+    """
+    Return byte offsets where the last lines lines of fp start, oldest first;
+    fewer if fp has fewer lines.
+
+    Scan backwards from the end of the file in blocks, so the cost does not
+    depend on the size of the file.
+    """
+    end = fp.seek(0, os.SEEK_END)
+    offsets = []
+    position = end
+    while position > 0 and len(offsets) < lines:
+        start = max(position - block_size, 0)
+        fp.seek(start)
+        block = fp.read(position - start)
+        index = len(block)
+        while len(offsets) < lines:
+            index = block.rfind(b"\n", 0, index)
+            if index == -1:
+                break
+            # a final newline does not start another line
+            if start + index + 1 < end:
+                offsets.append(start + index + 1)
+        position = start
+
+    if len(offsets) < lines and end > 0:
+        offsets.append(0)
+
+    offsets.reverse()
+    return offsets
+
+
+def state_path(path: Path):
+    """
+    Path to verified hash state of the .jlap file at path.
+    """
+    return path.with_name(path.name + ".state")
+
+
+def read_state(path: Path) -> Optional[Tuple[int, bytes]]:
+    """
+    Return (offset, lineid) written by write_state() if path has not changed
+    since, else None.
+    """
+    try:
+        state = json.loads(state_path(path).read_text())
+        if state["size"] != path.stat().st_size:
+            return None
+        return state["offset"], bytes.fromhex(state["lineid"])
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def write_state(path: Path, state: Tuple[int, bytes]):
+    """
+    Save (offset, lineid) from verify() or JlapWriter.state() for path.
+    """
+    offset, lineid = state
+    state_path(path).write_text(
+        json.dumps(
+            {"offset": offset, "lineid": lineid.hex(), "size": path.stat().st_size}
+        )
+    )
+
+
+def copy_head(fp: IOBase, out: IOBase, size: int):
+    """
+    Copy the first size bytes of fp to out in blocks, without parsing them.
+    """
+    fp.seek(0)
+    while size:
+        block = fp.read(min(size, TAIL_BLOCK_SIZE))
+        if not block:
+            raise JlapError("file is shorter than expected")
+        out.write(block)
+        size -= len(block)
+
+
+def verify(fp: IOBase, offset=0, lineid: Optional[bytes] = None) -> Tuple[int, bytes]:
+    """
+    Check the summary hash of a .jlap file without parsing its json.
+
+    Hash lines from byte offset onward, starting with lineid, the summary hash
+    of the lines before offset. If offset is 0, lineid is read from the first
+    line.
+
+    Return (offset, lineid) at the start of the next-to-last line, to check
+    only the new lines on a later call after lines are written at that offset.
+    Raise JlapError on mismatch.
+    """
+    fp.seek(offset)
+    if offset == 0:
+        first = fp.readline()
+        lineid = bytes.fromhex(first.rstrip(b"\n").decode("utf-8"))
+        offset = len(first)
+
+    state = (offset, lineid)
+    for line in fp:
+        if not line.endswith(b"\n"):  # last line
+            if lineid.hex() != line.decode("utf-8"):
+                raise JlapError("summary hash mismatch", lineid.hex(), line)
+            return state
+        state = (offset, lineid)
+        lineid = bhfunc(line[:-1], lineid).digest()
+        offset += len(line)
+
+    raise JlapError("missing summary hash")
+
+
 class JlapWriter:
     def __init__(self, fp: IOBase, lineid: str = ("0" * DIGEST_SIZE * 2)):
         lineid_bytes: bytes = bytes.fromhex(lineid)
         self.fp = fp
         self.fp.write(lineid_bytes.hex().encode("utf-8") + b"\n")
         self.lineid = lineid_bytes
+        self.target = None
+        self.offset = 0
+        self.last = None
+
+    @classmethod
+    def append(cls, fp: IOBase, out: IOBase, state: Optional[Tuple[int, bytes]] = None):
+        """
+        Continue existing .jlap file fp into new file out, replacing the
+        lines of fp from state's offset, by default its metadata
+        (next-to-last) line, and its summary hash.
+
+        state: (offset, lineid) from verify(), tail_state() or read_state(),
+        to avoid hashing the file again.
+
+        New lines are kept in memory until finish(), which copies fp up to
+        offset into out, then writes them. Replace fp's file with out's
+        afterwards, so readers never see a partly written file.
+        """
+        if state is None:
+            state = verify(fp)
+        writer = cls.__new__(cls)
+        writer.fp = BytesIO()
+        writer.source = fp
+        writer.target = out
+        writer.offset, writer.lineid = state
+        writer.last = None
+        return writer
 
     def write(self, obj):
         """
         Write one json line to file.
         """
-        line = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(
-            "utf-8"
+        self.write_raw(
+            json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
         )
+
+    def write_raw(self, line: bytes, validate=False):
+        """
+        Write one line of already-serialized json to file, without parsing it
+        unless validate is True.
+        """
+        if validate:
+            if b"\n" in line:
+                raise JlapError("newline in line", line[:64])
+            json.loads(line)
+        self.last = (self.offset + self.fp.tell(), self.lineid)
         self.lineid = bhfunc(line, self.lineid).digest()
         self.fp.write(line)
         self.fp.write(b"\n")
 
     def finish(self):
         self.fp.write(self.lineid.hex().encode("utf-8"))
+        if self.target:
+            copy_head(self.source, self.target, self.offset)
+            self.target.write(self.fp.getvalue())
+            self.target.flush()
+
+    def position(self) -> Tuple[int, bytes]:
+        """
+        Return (offset, lineid) at the start of the next line to be written.
+        """
+        return (self.offset + self.fp.tell(), self.lineid)
+
+    def state(self) -> Tuple[int, bytes]:
+        """
+        Return (offset, lineid) at the start of the last line written, the
+        metadata line, as returned by verify().
+        """
+        return self.last
+
+
+def tail_state(fp: IOBase) -> Tuple[Tuple[int, bytes], Optional[bytes]]:
+    """
+    Return ((offset, lineid) at the start of the tail of .jlap file fp, last
+    patch line or None).
+
+    The tail is the last patch, the squashed patches just before it, and the
+    metadata line. Hashes the whole file, checking its summary hash.
+    """
+    with JlapLines(fp) as jlap:
+        tail = list(itertools.islice(jlap.reversed(), 1, None))
+        last = None
+        offset = next(jlap.reversed()).offset
+        for index, line in enumerate(tail):
+            if index == 0:
+                last = line.raw
+            elif not line.raw.endswith(SQUASH_SUFFIX):
+                break
+            offset = line.offset
+
+        lineid = jlap.iv
+        found = None
+        for line in jlap:  # checks summary hash at the end
+            if line.offset == offset:
+                found = (offset, lineid)
+            lineid = line.lineid
+    return found, last
+
+
+def append_lines(
+    path: Path, lines: Iterable[bytes], metadata: dict, squashed: Iterable[bytes] = ()
+):
+    """
+    Write serialized patch lines after the patches in the .jlap file at path,
+    or to a new .jlap file if there is none, followed by metadata.
+
+    squashed are serialized squashed patches to the last patch's "to". They
+    replace the squashed patches before the old last patch, and are written
+    just before the new last patch.
+
+    path is replaced atomically by a temporary file, and the position of its
+    tail saved with write_state(); the existing lines are copied without
+    being hashed if read_state() is current.
+    """
+    temp = path.with_name(path.name + ".tmp")
+    with temp.open("wb") as out:
+        try:
+            fp = path.open("rb")
+        except FileNotFoundError:
+            fp = None
+            writer = JlapWriter(out)
+            patches = list(lines)
+        else:
+            state = read_state(path)
+            if state is None:
+                state, last = tail_state(fp)
+            else:
+                with JlapLines(fp) as jlap:
+                    tail = list(itertools.islice(jlap.reversed(), 2))
+                last = tail[1].raw if tail[1:] and tail[1].offset >= state[0] else None
+            writer = JlapWriter.append(fp, out, state)
+            patches = ([last] if last else []) + list(lines)
+        try:
+            for line in patches[:-1]:
+                writer.write_raw(line)
+            position = writer.position()
+            for line in list(squashed) + patches[-1:]:
+                writer.write_raw(line)
+            writer.write(metadata)
+            writer.finish()
+        finally:
+            if fp:
+                fp.close()
+    temp.replace(path)
+    write_state(path, position)
 
 
 def test():
@@ -7,13 +7,15 @@ Requirements: `pip install jsonpatch requests-cache`
 """
 import glob
 import hashlib
+import heapq
 import json
+import math
 import os
 import re
 import subprocess
 import sys
 
-import jsonpatch
+import fastpatch
 import requests_cache
 
 
@@ -59,27 +61,97 @@ def conda_normalize_hash(data):
     return data_hash
 
 
-def apply_patches(data, patches, have, want):
-    apply = []
-    for patch in reversed(patches):
-        if have == want:
-            break
-        if patch["to"] == want:
-            apply.append(patch)
+def weigh_raw(patch):
+    """
+    Cost of applying truncateable.lazy_patch(), by serialized size.
+    """
+    return len(patch["raw"])
+
+
+def weigh_ops(patch):
+    """
+    Cost of applying patch, by number of operations.
+    """
+    return len(patch["patch"])
+
+
+def weigh_bytes(patch):
+    """
+    Cost of applying patch, by serialized size.
+    """
+    return len(json.dumps(patch["patch"]))
+
+
+class PatchIndex:
+    """
+    Patches indexed by their "from" hash, to find the cheapest series of
+    patches between two hashes even if the patchset branches (regenerated or
+    re-based patches).
+    """
+
+    def __init__(self, patches, weigh=weigh_ops):
+        self.weigh = weigh
+        self.by_from = {}
+        for order, patch in enumerate(patches):
+            self.by_from.setdefault(patch["from"], []).append((order, patch))
+
+    def plan(self, have, want):
+        """
+        Return cheapest list of patches leading from have to want, oldest
+        first; [] if have == want; None if there is no path.
+        """
+        # Dijkstra; on equal cost, prefer patches that appear later
+        costs = {have: 0}
+        previous = {}
+        queue = [(0, 0, have)]
+        while queue:
+            cost, _, digest = heapq.heappop(queue)
+            if digest == want:
+                break
+            if cost > costs[digest]:
+                continue
+            for order, patch in self.by_from.get(digest, ()):
+                next_cost = cost + self.weigh(patch)
+                if next_cost < costs.get(patch["to"], math.inf):
+                    costs[patch["to"]] = next_cost
+                    previous[patch["to"]] = patch
+                    heapq.heappush(queue, (next_cost, -order, patch["to"]))
+        else:
+            if have != want:
+                return None
+
+        path = []
+        while want != have:
+            patch = previous[want]
+            path.append(patch)
             want = patch["from"]
+        path.reverse()
+        return path
+
 
-    if have != want:
+def patch_chain(patches, have, want):
+    """
+    Return patches leading from have to want, oldest first; [] if none.
+    """
+    apply = PatchIndex(patches).plan(have, want)
+
+    if apply is None:
         print(f"No patch from local revision {hf(have)}")
-        apply.clear()
+        return []
+
+    return apply
+
+
+def apply_patches(data, patches, have, want):
+    apply = patch_chain(patches, have, want)
 
     print(f"\nApply {len(apply)} patches {hf(have)} \N{RIGHTWARDS ARROW} {hf(want)}...")
 
-    while apply:
-        patch = apply.pop()
+    for patch in apply:
         print(
             f"{hf(patch['from'])} \N{RIGHTWARDS ARROW} {hf(patch['to'])}, {len(patch['patch'])} steps"
         )
-        data = jsonpatch.JsonPatch(patch["patch"]).apply(data, in_place=True)
+        data = fastpatch.apply_patch(data, patch["patch"])
 
     return data
 
@@ -2,13 +2,16 @@
 Fetch latest and append, replacing penultimate line of jlap
 """
 
-data = open("repodata.jlap", "rb").read()
+import sys
+from pathlib import Path
 
-with open("repodata.jlap", "rb+") as jlap:
-    offsets = [0]
-    for line in jlap:
-        print(line[-10:])
-        offsets.append(len(line) + offsets[-1])
+sys.path.insert(0, str(Path(__file__).parents[1] / "app"))
+
+from truncateable import tail_offsets
 
-print(offsets[-10:])
-print(data[offsets[-3] :])  # where we want to overwrite
+with open("repodata.jlap", "rb+") as jlap:
+    # start of each of the last 10 lines, without reading the whole file
+    offsets = tail_offsets(jlap, 10)
+    print(offsets)
+    jlap.seek(offsets[-2])
+    print(jlap.read())  # where we want to overwrite